@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import sudoku
+
+# Number of givens left in the generated puzzles of each grade.
+GRADES = {'easy': 40, 'medium': 32, 'hard': 26, 'sparse': 22}
+STAGES = ('construct', 'preassess', 'forced', 'marked', 'preemptive', 'render')
+PERCENTILES = (50, 90, 99)
+
+# A valid solution that random_solution() shuffles.
+PATTERN = [(3*(r % 3) + r // 3 + c) % 9 + 1 for r in range(9) for c in range(9)]
+
+
+def shuffle(cells, rng):
+    # Relabels the digits, permutes the bands, stacks, rows and columns of
+    # a grid and transposes it half of the time, which keeps a solution a
+    # solution and a puzzle equivalent to the one given.
+    digits = [0] + rng.sample(range(1, 10), 9)
+    rows = [3*b + r for b in rng.sample(range(3), 3) for r in rng.sample(range(3), 3)]
+    cols = [3*s + c for s in rng.sample(range(3), 3) for c in rng.sample(range(3), 3)]
+    transpose = rng.random() < 0.5
+    shuffled = []
+    for r in rows:
+        for c in cols:
+            shuffled.append(digits[cells[9*c + r] if transpose else cells[9*r + c]])
+    return shuffled
+
+
+def random_solution(rng):
+    return shuffle(PATTERN, rng)
+
+
+def make_corpus(size, givens, rng):
+    # Returns size puzzle lines keeping givens random cells of random
+    # solutions. The puzzles need not have a unique solution.
+    lines = []
+    for _ in range(size):
+        cells = random_solution(rng)
+        kept = set(rng.sample(range(81), givens))
+        lines.append(''.join(str(x) if cell in kept else '0' for cell, x in enumerate(cells)))
+    return lines
+
+
+def time_stages(lines, directory=None):
+    # Runs every stage on every puzzle and returns the list of the times
+    # taken by each stage. The TeX documents are rendered to memory, and
+    # also written to directory if one is given.
+    times = {stage: [] for stage in STAGES}
+    if directory is not None:
+        times['write'] = []
+    clock = time.perf_counter
+    silent = io.StringIO()
+    for i, line in enumerate(lines):
+        start = clock()
+        s = sudoku.Sudoku.from_line(line, os.path.join(directory or '', 'puzzle_%d' % i))
+        times['construct'].append(clock() - start)
+
+        start = clock()
+        with contextlib.redirect_stdout(silent):
+            s.preassess()
+        times['preassess'].append(clock() - start)
+        silent.seek(0)
+        silent.truncate()
+
+        start = clock()
+        s.force()
+        times['forced'].append(clock() - start)
+
+        start = clock()
+        s.mark()
+        times['marked'].append(clock() - start)
+
+        start = clock()
+        s.work()
+        times['preemptive'].append(clock() - start)
+
+        start = clock()
+        for stage in (sudoku.BARE, sudoku.FORCED, sudoku.MARKED, sudoku.WORKED):
+            sudoku.RENDERER.write(io.StringIO(), [s.tex_table(stage)])
+        times['render'].append(clock() - start)
+
+        if directory is not None:
+            start = clock()
+            for stage in (sudoku.BARE, sudoku.FORCED, sudoku.MARKED, sudoku.WORKED):
+                s.write_tex(None, stage)
+            times['write'].append(clock() - start)
+    return times
+
+
+def check_cache(lines, rng, variants=4):
+    # Runs shuffled variants of every puzzle, and of the puzzle without its
+    # 1s so that a digit is missing from the givens, through a
+    # SolutionCache and compares the states and solution with those found
+    # without it. Returns the number of variants that differ.
+    cache = sudoku.SolutionCache()
+    failures = 0
+    for line in lines:
+        cells = [int(x) for x in line]
+        for puzzle in (cells, [0 if x == 1 else x for x in cells]):
+            for _ in range(variants):
+                variant = shuffle(puzzle, rng)
+                cached = sudoku.Sudoku.from_cells(variant.copy())
+                solution = cache.run(cached)
+                direct = sudoku.Sudoku.from_cells(variant.copy())
+                direct.mark()
+                same = cached.stage_state(sudoku.MARKED) == direct.stage_state(sudoku.MARKED)
+                direct.work()
+                same = same and (cached.cells, cached.masks) == (direct.cells, direct.masks)
+                if solution is None:
+                    same = same and (not direct.is_consistent() or next(direct.solutions(), None) is None)
+                else:
+                    rows = [solution[r][c] for r in range(9) for c in range(9)]
+                    same = same and all(x in (0, y) for x, y in zip(variant, rows)) and all(
+                        sorted(rows[cell] for cell in unit) == list(range(1, 10)) for unit in sudoku.UNITS)
+                failures += not same
+    return failures
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    summary = {
+        'count': len(samples),
+        'total_s': total,
+        'throughput_per_s': len(samples) / total if total else None,
+        'mean_us': 1e6 * total / len(samples),
+        'max_us': 1e6 * samples[-1],
+    }
+    for p in PERCENTILES:
+        rank = max(0, -(-p * len(samples) // 100) - 1)
+        summary['p%d_us' % p] = 1e6 * samples[rank]
+    return summary
+
+
+def run(grades, sizes, seed, disk=False, trace_memory=False):
+    results = []
+    for grade in grades:
+        for size in sizes:
+            rng = random.Random('%s-%s-%s' % (seed, grade, size))
+            lines = make_corpus(size, GRADES[grade], rng)
+            if trace_memory:
+                tracemalloc.start()
+            with tempfile.TemporaryDirectory() if disk else contextlib.nullcontext() as directory:
+                start = time.perf_counter()
+                times = time_stages(lines, directory)
+                elapsed = time.perf_counter() - start
+            result = {
+                'grade': grade,
+                'givens': GRADES[grade],
+                'size': size,
+                'elapsed_s': elapsed,
+                'puzzles_per_s': size / elapsed if elapsed else None,
+                'stages': {stage: summarize(samples) for stage, samples in times.items()},
+            }
+            if trace_memory:
+                result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the stages of the Crook pipeline on generated puzzles.')
+    parser.add_argument('-g', '--grades', default=','.join(GRADES), help='comma separated grades among ' + ', '.join(GRADES))
+    parser.add_argument('-n', '--sizes', default='1,100,1000', help='comma separated corpus sizes')
+    parser.add_argument('-s', '--seed', default='0', help='seed of the generated corpora')
+    parser.add_argument('--disk', action='store_true', help='also time writing the .tex files to a temporary directory')
+    parser.add_argument('--trace-memory', action='store_true', help='report the peak of traced allocations (slows the run)')
+    parser.add_argument('--check-cache', type=int, metavar='N', default=0,
+                        help='first check the solution cache on N puzzles of each grade, failing if it differs')
+    parser.add_argument('-o', '--output', default='-', help='file for the JSON report, - for standard output')
+    args = parser.parse_args(argv)
+
+    grades = args.grades.split(',')
+    for grade in grades:
+        if grade not in GRADES:
+            parser.error('unknown grade ' + grade)
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError:
+        parser.error('corpus sizes must be integers')
+    if min(sizes) < 1:
+        parser.error('corpus sizes must be at least 1')
+    if args.check_cache:
+        for grade in grades:
+            rng = random.Random('%s-%s-cache' % (args.seed, grade))
+            failures = check_cache(make_corpus(args.check_cache, GRADES[grade], rng), rng)
+            if failures:
+                parser.error('%d cached results of %s puzzles differ' % (failures, grade))
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'runs': run(grades, sizes, args.seed, args.disk, args.trace_memory),
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
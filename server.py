@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import io
+import json
+import os
+import signal
+import sys
+import time
+
+import sudoku
+
+# Operations a request can ask for. They are run in this order, whatever
+# their order in the request, so that each stage is reached before the next.
+OPERATIONS = ('preassess', 'forced', 'marked', 'worked', 'tex', 'solve')
+
+
+def read_grid(grid):
+    # Builds the grid of a request: a line as in the batch mode, the text of
+    # a .txt file or a list of rows.
+    if isinstance(grid, str):
+        if '\n' in grid.strip():
+            return sudoku.Sudoku.from_string(grid)
+        return sudoku.Sudoku.from_line(grid)
+    if isinstance(grid, list):
+        return sudoku.Sudoku.from_grid(grid)
+    raise sudoku.SudokuError('Incorrect input')
+
+
+def state(cells, masks=None):
+    # Returns the cells of a grid as a line and, if masks is given, the
+    # candidates of every cell as a string of digits.
+    result = {'cells': sudoku.format_line(cells)}
+    if masks is not None:
+        result['candidates'] = [''.join(sudoku.SYMBOLS[d] for d in sudoku.mask_digits(m)) for m in masks]
+    return result
+
+
+def handle(request, deadline=None):
+    # Returns the response to a request, without its id. The search of
+    # solve gives up once time.time() passes deadline.
+    ops = request.get('ops', ['solve'])
+    if not isinstance(ops, list) or not all(op in OPERATIONS for op in ops):
+        return {'ok': False, 'error': 'Unknown operation'}
+    try:
+        s = read_grid(request.get('grid'))
+        results = {}
+        if 'preassess' in ops:
+            results['preassess'] = s.validate()
+        if 'forced' in ops:
+            if not s.forced:
+                s.force()
+            results['forced'] = state(s.stage_state(sudoku.FORCED)[0])
+        if 'marked' in ops:
+            if not s.marked:
+                s.mark()
+            results['marked'] = state(*s.stage_state(sudoku.MARKED))
+        if 'worked' in ops:
+            if not s.worked:
+                s.work()
+            results['worked'] = state(*s.stage_state(sudoku.WORKED))
+        if 'tex' in ops:
+            out = io.StringIO()
+            s.write_tex(out, request.get('stage', sudoku.WORKED))
+            results['tex'] = out.getvalue()
+        if 'solve' in ops:
+            try:
+                grid, stats = s.solve(request.get('method', sudoku.SEARCH), deadline)
+                results['solve'] = {'solution': sudoku.format_line(x for row in grid for x in row), 'stats': stats}
+            except sudoku.SudokuError as e:
+                if e.message != 'No solution':
+                    raise
+                results['solve'] = {'solution': None, 'stats': None}
+    except sudoku.SudokuError as e:
+        return {'ok': False, 'error': e.message}
+    return {'ok': True, 'results': results}
+
+
+def handle_batch(requests, deadlines=None):
+    # Runs in a worker process, deadlines[i] being the time.time() after
+    # which request i is no longer worth answering. The responses are only
+    # sent back with the whole batch, so a request is also given up by the
+    # deadlines the requests before it can still meet. A request failing in
+    # an unexpected way, or out of time, only fails its own response.
+    responses = []
+    for i, request in enumerate(requests):
+        deadline = None
+        if deadlines:
+            now = time.time()
+            if now > deadlines[i]:
+                responses.append({'ok': False, 'error': 'Timeout'})
+                continue
+            deadline = min(d for d in deadlines[:i + 1] if d >= now)
+        try:
+            responses.append(handle(request, deadline))
+        except Exception as e:
+            responses.append({'ok': False, 'error': 'Internal error: ' + repr(e)})
+    return responses
+
+
+class Server(object):
+    # Answers requests given as lines of JSON, one response line per
+    # request, in the order they complete and carrying the id of their
+    # request. The requests that arrive within delay seconds of each other
+    # are sent together, at most batch_size at a time, to a pool of jobs
+    # worker processes kept for the life of the server. Once max_pending
+    # requests are waiting for a batch, or twice as many batches as workers
+    # are running, input is no longer read until some complete. A request
+    # not answered within timeout seconds, or its own "timeout", gets an
+    # error, and its search is stopped so the rest of its batch still runs.
+    def __init__(self, jobs=None, batch_size=64, delay=0.002, timeout=10.0, max_pending=1024):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.delay = delay
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pool = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_pending)
+        self.slots = asyncio.Semaphore(2 * self.jobs)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        # Start every worker now rather than on the first requests.
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, handle_batch, []) for _ in range(self.jobs)))
+        self.batcher = asyncio.create_task(self.run_batches())
+
+    def close(self):
+        # Stops the workers without waiting for the batches they run.
+        self.batcher.cancel()
+        processes = list(self.pool._processes.values())
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Requests that timed out while queued are not run.
+            batch = [(request, future, deadline) for request, future, deadline in batch if not future.done()]
+            if not batch:
+                continue
+            await self.slots.acquire()
+            task = loop.run_in_executor(self.pool, handle_batch, [request for request, future, deadline in batch],
+                                        [deadline for request, future, deadline in batch])
+            task.add_done_callback(functools.partial(self.finish, batch))
+
+    def finish(self, batch, task):
+        self.slots.release()
+        try:
+            responses = task.result()
+        except Exception as e:
+            responses = [{'ok': False, 'error': 'Worker failed: ' + repr(e)}] * len(batch)
+        for (request, future, deadline), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+    async def respond(self, request, future, timeout, write):
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            response = {'ok': False, 'error': 'Timeout'}
+        try:
+            await write(dict(id=request.get('id'), **response))
+        except ConnectionError:
+            pass
+
+    async def serve(self, readline, write):
+        # Answers the requests read by the coroutine readline() until it
+        # returns an empty line, the coroutine write(response) sending a
+        # response back.
+        loop = asyncio.get_running_loop()
+        pending = set()
+        while True:
+            line = await readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                await write({'id': None, 'ok': False, 'error': 'Bad request'})
+                continue
+            timeout = request.get('timeout', self.timeout)
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                timeout = self.timeout
+            future = loop.create_future()
+            await self.queue.put((request, future, time.time() + timeout))
+            task = asyncio.create_task(self.respond(request, future, timeout, write))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            readline = reader.readline
+        except ValueError:
+            # A regular file, as with < requests.jsonl, cannot be watched by
+            # the event loop: it is read in a thread instead.
+            def readline():
+                return loop.run_in_executor(None, sys.stdin.buffer.readline)
+
+        async def write(response):
+            sys.stdout.write(json.dumps(response) + '\n')
+            sys.stdout.flush()
+
+        await self.serve(readline, write)
+
+    async def serve_socket(self, path):
+        async def connection(reader, writer):
+            async def write(response):
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+            try:
+                await self.serve(reader.readline, write)
+            except (ConnectionError, asyncio.CancelledError):
+                # The client went away, or the server is stopping: a
+                # cancelled handler would be logged as an error otherwise.
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_unix_server(connection, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+async def run(args):
+    server = Server(args.jobs, args.batch_size, args.delay / 1000, args.timeout, args.max_pending)
+    await server.start()
+    # Stop on SIGTERM as on ^C, shutting the worker processes down. The
+    # handler is set once the workers are started so that they do not
+    # inherit it and still die on the SIGTERM of close().
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        if args.socket:
+            await server.serve_socket(args.socket)
+        else:
+            await server.serve_stdio()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Answer Sudoku requests given as lines of JSON on standard input or a Unix socket.')
+    parser.add_argument('-s', '--socket', help='path of a Unix socket to listen on instead of standard input')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='most requests sent to a worker at a time')
+    parser.add_argument('-d', '--delay', type=float, default=2, help='milliseconds to wait for more requests of a batch')
+    parser.add_argument('-t', '--timeout', type=float, default=10, help='default timeout of a request in seconds')
+    parser.add_argument('--max-pending', type=int, default=1024, help='requests queued before input stops being read')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,614 @@
+import argparse
+import functools
 import itertools
-from copy import deepcopy
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import OrderedDict, deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 BOX = 'box'
 ROW = 'row'
 COL = 'col'
 
-class SudokuError(Exception):
-    def __init__(self, message):
-        self.message = message
+# Backends of Sudoku.solve()
+SEARCH = 'search'
+DLX = 'dlx'
 
+# Statuses reported by the batch mode and batch_propagate()
+SOLVED = 'solved'
+UNSOLVABLE = 'unsolvable'
+INVALID = 'invalid'
+STALLED = 'stalled'
+CONTRADICTION = 'contradiction'
 
-class Sudoku(object):
-    def __init__(self, filename):
-        self.header = '''\\documentclass[10pt]{article}
-\\usepackage[left=0pt,right=0pt]{geometry}
-\\usepackage{tikz}
-\\usetikzlibrary{positioning}
-\\usepackage{cancel}
-\\pagestyle{empty}
+# Orders of the boards handled. A board of order n has n² rows, columns and
+# boxes of n² cells each, and uses the digits 1 to n².
+ORDERS = (2, 3, 4, 5)
+SIZES = tuple(order * order for order in ORDERS)
 
-\\newcommand{\\N}[5]{\\tikz{\\node[label=above left:{\\tiny #1},
-                               label=above right:{\\tiny #2},
-                               label=below left:{\\tiny #3},
-                               label=below right:{\\tiny #4}]{#5};}}
+# Symbols of the values of the cells in lines: digits, then letters from 10 on.
+SYMBOLS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
-\\begin{document}
+# Longest preemptive sets looked for. Every set matters on 9x9 boards, where
+# at most 4 of the 9 cells of a unit need be tried, but the search over the
+# 25 cells of the units of a 25x25 board has to be cut short.
+SUBSET_LIMIT = 4
 
-\\tikzset{every node/.style={minimum size=.5cm}}
 
-\\begin{center}
-\\begin{tabular}{||@{}c@{}|@{}c@{}|@{}c@{}||@{}c@{}|@{}c@{}|@{}c@{}||@{}c@{}|@{}c@{}|@{}c@{}||}\\hline\\hline
-'''
-        self.template = '''% Line 1
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 2
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 3
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline\\hline
-
-% Line 4
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 5
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 6
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline\\hline
-
-% Line 7
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 8
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline
-
-% Line 9
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} &
-\\N{}{}{}{}{} & \\N{}{}{}{}{} & \\N{}{}{}{}{} \\\ \\hline\\hline
+def mask_digits(mask):
+    # Returns the digits whose bits are set in mask, in increasing order.
+    return tuple(d for d in range(1, mask.bit_length() + 1) if mask >> (d - 1) & 1)
+
+
+def mask_set(mask):
+    return frozenset(mask_digits(mask))
+
+
+# Most values a MaskTable keeps.
+MASK_TABLE_SIZE = 4096
+
+
+class MaskTable(dict):
+    # Lookup table of a function of the candidate masks, filled in as the
+    # masks are met, for the orders with too many masks to list them all.
+    # Past maxsize values the oldest is dropped, so that a long-running
+    # process meeting ever new masks does not keep them all.
+    def __init__(self, function, maxsize=MASK_TABLE_SIZE):
+        self.function = function
+        self.maxsize = maxsize
+
+    def __missing__(self, mask):
+        if len(self) >= self.maxsize:
+            del self[next(iter(self))]
+        value = self[mask] = self.function(mask)
+        return value
+
+
+class Geometry(object):
+    # The tables of the boards of a given order. Cells are numbered row by
+    # row, and the units are the rows, then the columns, then the boxes, each
+    # given as a tuple of cell indices.
+    def __init__(self, order):
+        size = order * order
+        count = size * size
+        self.order = order
+        self.size = size
+        self.cell_count = count
+        self.unit_count = 3 * size
+        # Candidates are stored as masks of size bits, bit d-1 standing for digit d.
+        self.all_digits = (1 << size) - 1
+        self.digit_masks = [0] + [1 << (d - 1) for d in range(1, size + 1)]
+        if size <= 9:
+            self.mask_digits = [mask_digits(m) for m in range(self.all_digits + 1)]
+            self.mask_sets = [frozenset(digits) for digits in self.mask_digits]
+        else:
+            self.mask_digits = MaskTable(mask_digits)
+            self.mask_sets = MaskTable(mask_set)
+        # Characters standing for a cell in a line, '.' being an empty cell.
+        letters = SYMBOLS[10:size + 1]
+        self.symbols = ('.' + SYMBOLS[:size + 1] + letters.lower()).encode('ascii')
+
+        self.row_of = tuple(cell // size for cell in range(count))
+        self.col_of = tuple(cell % size for cell in range(count))
+        self.box_of = tuple(order*(cell // (order*size)) + cell % size // order for cell in range(count))
+        self.row_units = tuple(tuple(size*i + j for j in range(size)) for i in range(size))
+        self.col_units = tuple(tuple(size*i + j for i in range(size)) for j in range(size))
+        self.box_units = tuple(tuple(cell for cell in range(count) if self.box_of[cell] == b) for b in range(size))
+        self.units = self.row_units + self.col_units + self.box_units
+        self.unit_kinds = (ROW,) * size + (COL,) * size + (BOX,) * size
+        self.cell_units = tuple((self.row_of[cell], size + self.col_of[cell], 2*size + self.box_of[cell])
+                                for cell in range(count))
+        self.peers = tuple(tuple(sorted(set(self.units[r] + self.units[c] + self.units[b]) - {cell}))
+                           for cell, (r, c, b) in enumerate(self.cell_units))
+        self.transposed = tuple(size * self.col_of[cell] + self.row_of[cell] for cell in range(count))
+
+
+@functools.lru_cache(maxsize=None)
+def geometry(order):
+    return Geometry(order)
+
+
+def order_of(count):
+    # Returns the order of the boards of count cells.
+    for order in ORDERS:
+        if order ** 4 == count:
+            return order
+    raise SudokuError('Incorrect input')
+
+
+# The tables of 9x9 boards.
+STANDARD = geometry(3)
+ALL_DIGITS = STANDARD.all_digits
+DIGIT_MASKS = STANDARD.digit_masks
+MASK_DIGITS = STANDARD.mask_digits
+MASK_SETS = STANDARD.mask_sets
+MASK_SIZES = [len(digits) for digits in MASK_DIGITS]
+ROW_OF = STANDARD.row_of
+COL_OF = STANDARD.col_of
+BOX_OF = STANDARD.box_of
+ROW_UNITS = STANDARD.row_units
+COL_UNITS = STANDARD.col_units
+BOX_UNITS = STANDARD.box_units
+UNITS = STANDARD.units
+UNIT_KINDS = STANDARD.unit_kinds
+CELL_UNITS = STANDARD.cell_units
+PEERS = STANDARD.peers
+TRANSPOSED = STANDARD.transposed
+
+
+def subsets(masks, limit):
+    # Yields (chosen, union) for every set of at most limit of the given
+    # masks whose union has as many bits as the set has members, chosen
+    # holding bit i when masks[i] is in the set.
+    stack = [(0, 0, 0, 0)]
+    while stack:
+        start, size, chosen, union = stack.pop()
+        for i in range(start, len(masks)):
+            if not masks[i]:
+                continue
+            new_union = union | masks[i]
+            count = new_union.bit_count()
+            if count > limit:
+                continue
+            if count == size + 1:
+                yield chosen | 1 << i, new_union
+            elif size + 1 < limit:
+                stack.append((i + 1, size + 1, chosen | 1 << i, new_union))
+
+
+# Maps the bytes of '.', the digits and the letters, in either case, to the
+# values of the cells.
+CELL_VALUES = bytes.maketrans(b'.' + SYMBOLS.encode('ascii') + SYMBOLS[10:].lower().encode('ascii'),
+                              bytes([0]) + bytes(range(len(SYMBOLS))) + bytes(range(10, len(SYMBOLS))))
+
+
+def format_line(cells):
+    # Returns the line of the given cells, as read by Sudoku.from_line().
+    return ''.join(SYMBOLS[x] for x in cells)
+
+
+def parse_grid(data):
+    # Reads the cells of a grid given as one line per row, ignoring blank
+    # lines, the number of rows telling the order. A row is either as many
+    # characters as cells, with spaces anywhere, or as many tokens separated
+    # by whitespace, values above 9 being written as letters from A on or,
+    # above 9x9, as numbers without leading zeros.
+    if not isinstance(data, bytes):
+        try:
+            data = bytes(data)
+        except (TypeError, ValueError):
+            raise SudokuError('Incorrect input')
+    rows = [line.split() for line in data.splitlines() if line.strip()]
+    size = len(rows)
+    if size not in SIZES:
+        raise SudokuError('Incorrect input')
+    symbols = geometry(ORDERS[SIZES.index(size)]).symbols
+    cells = []
+    for tokens in rows:
+        if len(tokens) != size:
+            tokens = [bytes([x]) for x in b''.join(tokens)]
+            if len(tokens) != size:
+                raise SudokuError('Incorrect input')
+        for token in tokens:
+            if size > 9 and token.isdigit() and int(token) <= size and (token == b'0' or token[:1] != b'0'):
+                cells.append(int(token))
+            elif len(token) == 1 and not token.translate(None, symbols):
+                cells.append(token.translate(CELL_VALUES)[0])
+            else:
+                raise SudokuError('Incorrect input')
+    return cells
+
+
+def read_corpus(path):
+    # Yields (offset, Sudoku) for every puzzle of a file holding one per
+    # line as in the batch mode, offset being where its line starts, or
+    # (offset, None) for a line that cannot be read. The lines are read
+    # from a memory map of the file and turned into cells straight from
+    # their bytes.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b'\n', start)
+                if end < 0:
+                    end = size
+                line = mm[start:end].strip()
+                if line:
+                    try:
+                        sudoku = Sudoku.from_line(line)
+                    except SudokuError:
+                        sudoku = None
+                    yield start, sudoku
+                start = end + 1
+
+
+class DancingLinks(object):
+    # Knuth's Algorithm X on a sparse 0/1 matrix whose nodes are linked
+    # left/right within their row and up/down within their column. Node 0 is
+    # the root and nodes 1 to columns are the column headers.
+    def __init__(self, columns, rows):
+        L = [i - 1 for i in range(columns + 1)]
+        R = [i + 1 for i in range(columns + 1)]
+        L[0] = columns
+        R[columns] = 0
+        U = list(range(columns + 1))
+        D = list(range(columns + 1))
+        C = list(range(columns + 1))
+        self.size = [0] * (columns + 1)
+        self.row_of = [-1] * (columns + 1)
+        for r, row in enumerate(rows):
+            first = None
+            for col in row:
+                c = col + 1
+                node = len(C)
+                C.append(c)
+                self.row_of.append(r)
+                U.append(U[c])
+                D.append(c)
+                D[U[c]] = node
+                U[c] = node
+                self.size[c] += 1
+                if first is None:
+                    first = node
+                    L.append(node)
+                    R.append(node)
+                else:
+                    L.append(L[first])
+                    R.append(first)
+                    R[L[first]] = node
+                    L[first] = node
+        self.L, self.R, self.U, self.D, self.C = L, R, U, D, C
+
+    def cover(self, c):
+        L, R, U, D, C, size = self.L, self.R, self.U, self.D, self.C, self.size
+        L[R[c]] = L[c]
+        R[L[c]] = R[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                U[D[j]] = U[j]
+                D[U[j]] = D[j]
+                size[C[j]] -= 1
+                j = R[j]
+            i = D[i]
+
+    def uncover(self, c):
+        L, R, U, D, C, size = self.L, self.R, self.U, self.D, self.C, self.size
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                size[C[j]] += 1
+                U[D[j]] = j
+                D[U[j]] = j
+                j = L[j]
+            i = U[i]
+        L[R[c]] = c
+        R[L[c]] = c
+
+    def search(self, stats, deadline=None):
+        # Yields the row indices of every exact cover, always branching on
+        # the column with fewest nodes left. Raises SudokuError('Timeout')
+        # once time.time() passes deadline, if one is given.
+        L, R, D, C, size = self.L, self.R, self.D, self.C, self.size
+        chosen = []
+        while True:
+            if R[0] == 0:
+                yield [self.row_of[node] for node in chosen]
+            else:
+                c = R[0]
+                j = R[c]
+                while j != 0:
+                    if size[j] < size[c]:
+                        c = j
+                    j = R[j]
+                if size[c] > 0:
+                    self.cover(c)
+                    r = D[c]
+                    chosen.append(r)
+                    stats['nodes'] += 1
+                    if deadline is not None and time.time() > deadline:
+                        raise SudokuError('Timeout')
+                    stats['max_depth'] = max(stats['max_depth'], len(chosen))
+                    j = R[r]
+                    while j != r:
+                        self.cover(C[j])
+                        j = R[j]
+                    continue
+                stats['backtracks'] += 1
+
+            while chosen:
+                r = chosen.pop()
+                j = L[r]
+                while j != r:
+                    self.uncover(C[j])
+                    j = L[j]
+                c = C[r]
+                r = D[r]
+                if r != c:
+                    chosen.append(r)
+                    stats['nodes'] += 1
+                    if deadline is not None and time.time() > deadline:
+                        raise SudokuError('Timeout')
+                    j = R[r]
+                    while j != r:
+                        self.cover(C[j])
+                        j = R[j]
+                    break
+                self.uncover(c)
+            else:
+                return
+
+
+# Stages of the TeX output
+BARE = 'bare'
+FORCED = 'forced'
+MARKED = 'marked'
+WORKED = 'worked'
+
+
+class TexRenderer(object):
+    # Writes grids as LaTeX tables of tikz nodes, a cell being drawn as
+    # \N{}{}{}{}{} with its candidates spread over the four corner labels
+    # and its digit in the middle. The layout of the table is built once,
+    # and the labels of a cell are looked up from its candidate mask and
+    # the mask of its cancelled candidates.
+    preamble = r'''\documentclass[10pt]{article}
+\usepackage[left=0pt,right=0pt]{geometry}
+\usepackage{tikz}
+\usetikzlibrary{positioning}
+\usepackage{cancel}
+\pagestyle{empty}
+
+\newcommand{\N}[5]{\tikz{\node[label=above left:{\tiny #1},
+                               label=above right:{\tiny #2},
+                               label=below left:{\tiny #3},
+                               label=below right:{\tiny #4}]{#5};}}
+
+\begin{document}
+
+\tikzset{every node/.style={minimum size=.5cm}}
+
 '''
-        self. footer = '''\end{tabular}
+    table_end = r'''\end{tabular}
 \end{center}
-
-\end{document}
 '''
+    end = r'''\end{document}
+'''
+
+    def __init__(self, order=3):
+        size = order * order
+        self.order = order
+        self.size = size
+        boxes = '||'.join('|'.join(['@{}c@{}'] * order) for _ in range(order))
+        tabular = '\\begin{tabular}{||' + boxes + '||}\\hline\\hline\n'
+        if order > 3:
+            # Larger boards are scaled down to the width of the page.
+            self.preamble = self.preamble.replace('\\usepackage{tikz}\n', '\\usepackage{graphicx}\n\\usepackage{tikz}\n')
+            self.table_start = '\\begin{center}\n\\resizebox{\\linewidth}{!}{%\n' + tabular
+            self.table_end = '\\end{tabular}}\n\\end{center}\n'
+        else:
+            self.table_start = '\\begin{center}\n' + tabular
+        lines = []
+        for i in range(size):
+            rows = [' & '.join(['{}'] * order) for _ in range(order)]
+            rule = r' \\ \hline\hline' if i % order == order - 1 else r' \\ \hline'
+            lines.append('% Line ' + str(i + 1) + '\n' + ' &\n'.join(rows) + rule + '\n')
+        self.template = '\n'.join(lines)
+        if size <= 9:
+            self.labels = [self.make_labels(mask, 0) for mask in range(1 << size)]
+        else:
+            self.labels = MaskTable(functools.partial(self.make_labels, cancelled=0))
+        self.cancelled_labels = MaskTable(lambda key: self.make_labels(*key))
+
+    def make_labels(self, poss, cancelled):
+        # Spreads the digits over the four labels in runs of size // 4, the
+        # last label taking the digits left over.
+        width = self.size // 4
+        slots = [[], [], [], []]
+        for k in range(1, self.size + 1):
+            idx = min(3, (k - 1) // width)
+            bit = 1 << (k - 1)
+            if poss & bit:
+                slots[idx].append(SYMBOLS[k])
+            elif cancelled & bit:
+                slots[idx].append('\\cancel{' + SYMBOLS[k] + '}')
+        return ''.join('{' + ' '.join(slot) + '}' for slot in slots)
+
+    def table(self, cells, masks=None, cancelled=None):
+        # Returns the table of a grid, showing the candidates of masks and,
+        # crossed out, those of cancelled when they are given.
+        labels = self.labels
+        nodes = []
+        for cell in range(len(cells)):
+            if cancelled is not None and cancelled[cell]:
+                node_labels = self.cancelled_labels[masks[cell], cancelled[cell]]
+            else:
+                node_labels = labels[masks[cell] if masks is not None else 0]
+            x = cells[cell]
+            nodes.append('\\N' + node_labels + ('{' + SYMBOLS[x] + '}' if x > 0 else '{}'))
+        return self.table_start + self.template.format(*nodes) + self.table_end
+
+    def write(self, out, tables):
+        # Writes a document holding the given tables, one after the other.
+        out.write(self.preamble)
+        for table in tables:
+            out.write(table)
+            out.write('\n')
+        out.write(self.end)
 
+
+@functools.lru_cache(maxsize=None)
+def renderer(order):
+    return TexRenderer(order)
+
+
+RENDERER = renderer(3)
+
+
+def write_tex_document(out, sudokus, stage=BARE):
+    # Writes to out a single document showing every grid at the given
+    # stage, so that a whole batch takes one pdflatex run. The grids are
+    # all taken to be of the order of the first.
+    sudokus = iter(sudokus)
+    first = next(sudokus, None)
+    if first is None:
+        RENDERER.write(out, [])
+        return
+    first.renderer.write(out, (sudoku.tex_table(stage) for sudoku in itertools.chain([first], sudokus)))
+
+
+# Events passed to Sudoku.trace: (PLACE, cell, digit), (ELIMINATE, cell,
+# mask of the digits removed), (PREEMPTIVE, unit, [(cell, digits to
+# remove), ...]) and (GUESS, cell, digit).
+PLACE = 'place'
+ELIMINATE = 'eliminate'
+PREEMPTIVE = 'preemptive'
+GUESS = 'guess'
+
+
+class SudokuStats(object):
+    # Counters of the work done on a grid, kept by the solver as it goes,
+    # and the time spent in each stage.
+    def __init__(self):
+        self.placements = 0
+        self.eliminations = 0
+        self.propagations = 0
+        self.propagation_steps = 0
+        self.unit_scans = 0
+        self.preemptive_sets = {ROW: 0, COL: 0, BOX: 0}
+        self.search_nodes = 0
+        self.backtracks = 0
+        self.max_depth = 0
+        self.stage_times = {}
+
+    def add_time(self, stage, seconds):
+        self.stage_times[stage] = self.stage_times.get(stage, 0) + seconds
+
+    def add_search(self, stats):
+        self.search_nodes += stats['nodes']
+        self.backtracks += stats['backtracks']
+        self.max_depth = max(self.max_depth, stats['max_depth'])
+
+    def as_dict(self):
+        return {
+            'placements': self.placements,
+            'eliminations': self.eliminations,
+            'propagations': self.propagations,
+            'propagation_steps': self.propagation_steps,
+            'unit_scans': self.unit_scans,
+            'preemptive_sets': dict(self.preemptive_sets),
+            'search_nodes': self.search_nodes,
+            'backtracks': self.backtracks,
+            'max_depth': self.max_depth,
+            'stage_times': dict(self.stage_times),
+        }
+
+
+class SudokuError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Sudoku(object):
+    def __init__(self, filename):
         self.filename = filename.split('.txt')[0]
         try:
-            with open(file=filename, mode='r') as f:
-                content = f.read().replace(' ', '').split(sep='\n')
-                lines = content.copy()
-                [lines.remove(line) for line in content if not line]
-
-                grid = []
-                for line in lines:
-                    grid.append([int(x) for x in list(line)])
-                self.grid = grid
-                self.grid_tran = list(zip(*self.grid))
-                self.boxes = self.split_to_boxes()
-                self.find_possibilities()
-
-                self.forced = False
-                self.marked = False
-
-                # print(self.possibilities)
-        except Exception as e:
+            with open(file=filename, mode='rb') as f:
+                data = f.read()
+        except OSError:
+            raise SudokuError('Incorrect input')
+        self.load_cells(parse_grid(data))
+
+    @classmethod
+    def from_cells(cls, cells, filename='sudoku'):
+        # Builds a grid from the list of its digits read row by row, 81 of
+        # them for a 9x9 board, filename being the stem of the TeX files
+        # written.
+        sudoku = cls.__new__(cls)
+        sudoku.filename = filename
+        sudoku.load_cells(cells)
+        return sudoku
+
+    @classmethod
+    def from_bytes(cls, data, filename='sudoku'):
+        # Same input as a .txt file: one line per row, with blank lines
+        # ignored, as read by parse_grid().
+        return cls.from_cells(parse_grid(data), filename)
+
+    @classmethod
+    def from_string(cls, text, filename='sudoku'):
+        try:
+            data = text.encode('ascii')
+        except UnicodeEncodeError:
+            raise SudokuError('Incorrect input')
+        return cls.from_cells(parse_grid(data), filename)
+
+    @classmethod
+    def from_grid(cls, grid, filename='sudoku'):
+        # Builds a grid from its rows of digits, 0 for an empty cell, 9 rows
+        # of 9 digits for a 9x9 board.
+        try:
+            cells = [int(x) for line in grid for x in line]
+            size = len(grid)
+            shape_ok = size in SIZES and all(len(line) == size for line in grid)
+        except (TypeError, ValueError):
+            raise SudokuError('Incorrect input')
+        if not shape_ok or any(x < 0 or x > size for x in cells):
             raise SudokuError('Incorrect input')
+        return cls.from_cells(cells, filename)
+
+    @classmethod
+    def from_line(cls, line, filename='sudoku'):
+        # Builds a grid from a line of characters read row by row, with '0'
+        # or '.' for an empty cell, as used by the batch mode. The length of
+        # the line gives the order: 81 characters for a 9x9 board, 256 for a
+        # 16x16 one, with letters from A on for the digits above 9.
+        if isinstance(line, str):
+            try:
+                line = line.encode('ascii')
+            except UnicodeEncodeError:
+                raise SudokuError('Incorrect input')
+        line = line.strip()
+        if line.translate(None, geometry(order_of(len(line))).symbols):
+            raise SudokuError('Incorrect input')
+        return cls.from_cells(list(line.translate(CELL_VALUES)), filename)
+
+    def load_cells(self, cells):
+        self.geometry = geometry(order_of(len(cells)))
+        self.cells = cells
+        self.find_possibilities()
+        # Every change to the cells and candidates from then on is recorded
+        # as (cell, mask before, mask after, digit placed or 0), so that any
+        # earlier state can be gone back to or rebuilt. A state is named by
+        # the length the trail had then, and stage_marks names the state
+        # each stage was reached in.
+        self.trail = []
+        self.stage_marks = {BARE: 0}
+        # The (cell, digit, mark) of the digits written by set_cell(), mark
+        # naming a state before the changes the edit led to.
+        self.edits = []
+        self.givens = None
+        self.forced = False
+        self.marked = False
+        self.worked = False
+        self.stats = SudokuStats()
+        # Called as trace(event, ...) on every step of the solver if set.
+        self.trace = None
 
     '''
    0  0  1  9  0  0  0  0  8     
@@ -117,364 +623,807 @@ class Sudoku(object):
 
 
     def find_possibilities(self):
-        possibilties = []
-
-        for i in range(9):
-            row_possibilities = []
-            for j in range(9):
-                box_num = 3*(i//3) + j//3
-                tmp = set()
-                elem = self.grid[i][j]
-                if elem == 0:
-                    for p in range(1, 10):
-                        # print(i, j, box_num)
-                        if p not in self.grid[i] and p not in self.grid_tran[j] and p not in self.boxes[box_num]:
-                            tmp.add(p)
-                row_possibilities.append(tmp)
-            possibilties.append(row_possibilities)
-        self.possibilities = possibilties
-        self.possibilities_tran = [list(x) for x in list(zip(*self.possibilities))]
-        self.possibilities_boxes = self.split_to_boxes(self.possibilities)
-
-    def find_poss_combos(self):
-        poss_combos = []
-        for i in range(9):
-            row_combos = []
-            for j in range(9):
-                cell_combos = []
-                poss = tuple(self.possibilities[i][j])
-                cell_combos.append(poss)
-                for size in range(2, len(poss)):
-                    cell_combos.extend(list(itertools.combinations(poss, size)))
-                cell_combos = [set(x) for x in cell_combos]
-                row_combos.append(cell_combos)
-
-            poss_combos.append(row_combos)
-        self.poss_combos = poss_combos
-        self.poss_combos_tran = [list(x) for x in list(zip(*poss_combos))]
-        self.poss_combos_boxes = self.split_to_boxes(poss_combos)
+        # Rebuilds the used-digit mask of every unit and the candidate mask
+        # of every cell from the grid alone.
+        g = self.geometry
+        cells = self.cells
+        used = [0] * g.unit_count
+        for cell in range(g.cell_count):
+            elem = cells[cell]
+            if elem > 0:
+                bit = g.digit_masks[elem]
+                for u in g.cell_units[cell]:
+                    used[u] |= bit
+        masks = [0] * g.cell_count
+        for cell in range(g.cell_count):
+            if cells[cell] == 0:
+                r, c, b = g.cell_units[cell]
+                masks[cell] = g.all_digits & ~(used[r] | used[c] | used[b])
+        self.unit_used = used
+        self.masks = masks
 
+    def is_consistent(self):
+        # Tells whether no digit is given twice in the same unit.
+        cells = self.cells
+        for u, unit in enumerate(self.geometry.units):
+            if self.unit_used[u].bit_count() != sum(1 for cell in unit if cells[cell]):
+                return False
+        return True
 
-    def split_to_boxes(self, array=None):
-        array = array or self.grid
-        boxes = []
-        for i in (0, 3, 6):
+    def place(self, cell, digit):
+        # Writes digit in cell and removes it from the candidates of the
+        # cells sharing a row, column or box with it.
+        g = self.geometry
+        bit = g.digit_masks[digit]
+        trail = self.trail
+        masks = self.masks
+        trail.append((cell, masks[cell], 0, digit))
+        self.cells[cell] = digit
+        masks[cell] = 0
+        for u in g.cell_units[cell]:
+            self.unit_used[u] |= bit
+        for peer in g.peers[cell]:
+            if masks[peer] & bit:
+                trail.append((peer, masks[peer], masks[peer] & ~bit, 0))
+                masks[peer] &= ~bit
 
-            for j in (0, 3, 6):
-                tmp = []
-                tmp.extend(array[i][j : j+3])
-                tmp.extend(array[i+1][j : j + 3])
-                tmp.extend(array[i+2][j : j + 3])
-                boxes.append(tmp)
-        return boxes
+    def restrict(self, cell, mask):
+        # Narrows the candidates of cell down to mask.
+        self.trail.append((cell, self.masks[cell], mask, 0))
+        self.masks[cell] = mask
 
-    def preassess(self):
-        # print(self.grid)
+    def advance(self, cells, masks):
+        # Brings the grid to the given cells and candidates, which may only
+        # add digits and remove candidates, with one trail entry per cell
+        # changed.
+        g = self.geometry
+        used = self.unit_used
+        for cell in range(g.cell_count):
+            digit = 0 if self.cells[cell] else cells[cell]
+            if digit or masks[cell] != self.masks[cell]:
+                self.trail.append((cell, self.masks[cell], masks[cell], digit))
+                self.masks[cell] = masks[cell]
+                if digit:
+                    self.cells[cell] = digit
+                    for u in g.cell_units[cell]:
+                        used[u] |= g.digit_masks[digit]
 
-        if len(self.grid_tran) != 9:
-            # print(grid_tran)
-            raise SudokuError('Incorrect input')
-        no_soln = False
-        for line in self.grid:
-            for elem in set(line):
-                if elem > 0 and line.count(elem) > 1:
-                    no_soln = True
-                    print('There is clearly no solution.')
+    def undo(self, mark):
+        # Takes the grid back to the state named mark, dropping the trail
+        # entries recorded since.
+        g = self.geometry
+        trail, cells, masks, used = self.trail, self.cells, self.masks, self.unit_used
+        for i in range(len(trail) - 1, mark - 1, -1):
+            cell, before, after, digit = trail[i]
+            masks[cell] = before
+            if digit:
+                cells[cell] = 0
+                bit = ~g.digit_masks[digit]
+                for u in g.cell_units[cell]:
+                    used[u] &= bit
+        del trail[mark:]
+
+    def redo(self, entries):
+        # Applies trail entries taken off by undo() again, in order.
+        g = self.geometry
+        trail, cells, masks, used = self.trail, self.cells, self.masks, self.unit_used
+        for entry in entries:
+            cell, before, after, digit = entry
+            masks[cell] = after
+            if digit:
+                cells[cell] = digit
+                for u in g.cell_units[cell]:
+                    used[u] |= g.digit_masks[digit]
+            trail.append(entry)
+
+    def snapshot(self):
+        # Returns the state of the grid as the length of the trail and flat
+        # copies of the arrays, which restore() goes back to faster than
+        # undo() for the many entries of a search.
+        return len(self.trail), self.cells.copy(), self.masks.copy(), self.unit_used.copy()
+
+    def restore(self, snapshot):
+        mark, cells, masks, used = snapshot
+        self.cells[:] = cells
+        self.masks[:] = masks
+        self.unit_used[:] = used
+        del self.trail[mark:]
+
+    def state_at(self, mark):
+        # Returns copies of the cells and candidate masks of the state named
+        # mark, rebuilt from the trail without changing the grid.
+        cells = self.cells.copy()
+        masks = self.masks.copy()
+        trail = self.trail
+        for i in range(len(trail) - 1, mark - 1, -1):
+            cell, before, after, digit = trail[i]
+            masks[cell] = before
+            if digit:
+                cells[cell] = 0
+        return cells, masks
+
+    def states(self, start=0, stop=None):
+        # Yields the cells and candidate masks after each digit placed
+        # between the states named start and stop, replaying the trail from
+        # the first. The lists yielded are updated in place afterwards.
+        trail = self.trail
+        stop = len(trail) if stop is None else stop
+        cells, masks = self.state_at(start)
+        for i in range(start, stop):
+            cell, before, after, digit = trail[i]
+            masks[cell] = after
+            if digit:
+                cells[cell] = digit
+                yield cells, masks
+
+    def changes(self, start, stop=None):
+        # Returns {cell: (digit, removed)} for the cells changed between the
+        # states named start and stop, with the digit placed in the cell, or
+        # 0, and the mask of the candidates it lost.
+        first = {}
+        placed = {}
+        last = {}
+        for cell, before, after, digit in self.trail[start:stop]:
+            first.setdefault(cell, before)
+            last[cell] = after
+            if digit:
+                placed[cell] = digit
+        return {cell: (placed.get(cell, 0), first[cell] & ~last[cell]) for cell in first}
+
+    def stage_state(self, stage):
+        # Returns copies of the cells and candidate masks as they were once
+        # stage was reached.
+        if stage not in self.stage_marks:
+            raise SudokuError('Stage ' + str(stage) + ' not reached')
+        return self.state_at(self.stage_marks[stage])
+
+    def stage_diff(self, first, last):
+        # Returns the changes() from stage first to stage last.
+        if first not in self.stage_marks or last not in self.stage_marks:
+            raise SudokuError('Stage not reached')
+        return self.changes(self.stage_marks[first], self.stage_marks[last])
+
+    @property
+    def cells_after_marking(self):
+        return self.stage_state(MARKED)[0]
+
+    @property
+    def masks_after_marking(self):
+        return self.stage_state(MARKED)[1]
+
+    def propagate(self, cells=None, changed=None):
+        # Places naked and hidden singles until a fixed point is reached.
+        # Only the given cells (all cells by default) and the units of the
+        # cells whose candidates change are looked at again; those cells are
+        # appended to changed if a list is given. Returns False if some cell
+        # or some missing digit of a unit has no candidate left.
+        g = self.geometry
+        units, cell_units, peers, all_digits = g.units, g.cell_units, g.peers, g.all_digits
+        masks = self.masks
+        grid = self.cells
+        used = self.unit_used
+        record = self.trail.append
+        # A mask m has at most one bit set when m & (m - 1) is 0.
+        singles = deque(cell for cell in (range(g.cell_count) if cells is None else cells)
+                        if grid[cell] == 0 and masks[cell] & (masks[cell] - 1) == 0)
+        dirty = deque(range(g.unit_count)) if cells is None else deque({u for cell in cells for u in cell_units[cell]})
+        queued = [False] * g.unit_count
+        for u in dirty:
+            queued[u] = True
+        trace = self.trace
+        consistent = True
+        steps = placed = removed = 0
+
+        while singles or dirty:
+            steps += 1
+            if singles:
+                cell = singles.popleft()
+                if grid[cell]:
+                    continue
+                bit = masks[cell]
+                if bit == 0:
+                    consistent = False
                     break
-        if not no_soln:
-            for line in self.grid_tran:
-                for elem in set(line):
-                    if elem > 0 and line.count(elem) > 1:
-                        no_soln = True
-                        print('There is clearly no solution.')
-                        break
-        if not no_soln:
-            for line in self.boxes:
-                for elem in set(line):
-                    if elem > 0 and line.count(elem) > 1:
-                        no_soln = True
-                        print('There is clearly no solution.')
-                        break
-        if not no_soln:
-            print('There might be a solution.')
+            else:
+                u = dirty.popleft()
+                queued[u] = False
+                # Digits seen in exactly one cell of the unit are hidden singles.
+                once = twice = 0
+                for cell in units[u]:
+                    m = masks[cell]
+                    twice |= once & m
+                    once |= m
+                missing = all_digits & ~used[u]
+                if missing & ~once:
+                    consistent = False
+                    break
+                hidden = missing & once & ~twice
+                if not hidden:
+                    continue
+                bit = hidden & -hidden
+                cell = next(cell for cell in units[u] if masks[cell] & bit)
+                if hidden != bit and not queued[u]:
+                    dirty.append(u)
+                    queued[u] = True
+
+            digit = bit.bit_length()
+            record((cell, masks[cell], 0, digit))
+            grid[cell] = digit
+            masks[cell] = 0
+            placed += 1
+            if trace is not None:
+                trace(PLACE, cell, digit)
+            if changed is not None:
+                changed.append(cell)
+            for u in cell_units[cell]:
+                used[u] |= bit
+                if not queued[u]:
+                    dirty.append(u)
+                    queued[u] = True
+            for peer in peers[cell]:
+                m = masks[peer]
+                if m & bit:
+                    record((peer, m, m & ~bit, 0))
+                    m &= ~bit
+                    masks[peer] = m
+                    removed += 1
+                    if trace is not None:
+                        trace(ELIMINATE, peer, bit)
+                    if changed is not None:
+                        changed.append(peer)
+                    if m & (m - 1) == 0:
+                        singles.append(peer)
+                    for u in cell_units[peer]:
+                        if not queued[u]:
+                            dirty.append(u)
+                            queued[u] = True
+
+        stats = self.stats
+        stats.propagations += 1
+        stats.propagation_steps += steps
+        stats.placements += placed
+        stats.eliminations += removed
+        return consistent
+
+    @property
+    def renderer(self):
+        return renderer(self.geometry.order)
+
+    @property
+    def grid(self):
+        cells = self.cells
+        size = self.geometry.size
+        return [cells[size*i : size*i + size] for i in range(size)]
+
+    @property
+    def grid_tran(self):
+        cells = self.cells
+        size = self.geometry.size
+        return [cells[j : size*size : size] for j in range(size)]
+
+    @property
+    def boxes(self):
+        cells = self.cells
+        return [[cells[cell] for cell in unit] for unit in self.geometry.box_units]
 
-    def bare_tex_output(self):
-        vals = ['{}']*5
-        cons_vals = []
-        for line in self.grid:
-            for x in line:
-                if x > 0:
-                    vals[-1] = '{' + str(x) + '}'
-                cons_vals.extend(vals)
-                vals[-1] = '{}'
-        with open(self.filename+'_bare.tex', 'w') as f:
-            f.write(self.header)
-            f.write(self.template.format(*cons_vals))
-            f.write(self.footer)
-
-    def forced_tex_output(self):
-        grid_modified = False
-        for i in range(9):
-            for j in range(9):
-                # if i==8 and j==3:
-                #     print(self.possibilities)
-                elem = self.grid[i][j]
-                possibilities = self.possibilities[i][j].copy()
-                if elem == 0:
-                    if len(possibilities) == 1:
-                        self.possibilities[i][j].pop()
-                        # print('pop', self.possibilities[i][j])
-                        poss = possibilities.pop()
-                        # print('poss', poss)
-                        self.grid[i][j] = poss
-                        self.grid_tran = list(zip(*self.grid))
-                        self.boxes = self.split_to_boxes()
-                        grid_modified = True
-                        self.find_possibilities()
-                        # print('grid_poss', i, j, poss, self.grid[i][j])
-                        # [self.possibilities[i][r].discard(poss) for r in range(9)]
-                        # sel
-                        #
-                        #
-                        # f.possibilities_tran = [list(x) for x in list(zip(*self.possibilities))]
-                        # self.possibilities_boxes = self.split_to_boxes(self.possibilities)
-                        # [self.possibilities_tran[i][r].discard(poss) for r in range(9)]
-                        # [self.possibilities[i][r].discard(poss) for r in range(9)]
-                        # self.forced_tex_output()
+    def unit_possibilities(self, masks, units):
+        mask_sets = self.geometry.mask_sets
+        return [[mask_sets[masks[cell]] for cell in unit] for unit in units]
+
+    @property
+    def possibilities(self):
+        return self.unit_possibilities(self.masks, self.geometry.row_units)
+
+    @property
+    def possibilities_tran(self):
+        return self.unit_possibilities(self.masks, self.geometry.col_units)
+
+    @property
+    def possibilities_boxes(self):
+        return self.unit_possibilities(self.masks, self.geometry.box_units)
+
+    @property
+    def possibilities_after_marking(self):
+        return self.unit_possibilities(self.masks_after_marking, self.geometry.row_units)
+
+    def split_to_boxes(self, array=None):
+        array = array or self.grid
+        flat = [x for line in array for x in line]
+        return [[flat[cell] for cell in unit] for unit in self.geometry.box_units]
+
+    def validate(self, propagate=True):
+        # Checks the grid in a single pass over its cells, keeping the mask
+        # of the digits met in each unit. Returns a dictionary with:
+        # conflicts, the cells holding a digit met twice in one of their
+        # units; units, those units as (kind, index) pairs; empty, the empty
+        # cells left without candidates, after propagating singles if
+        # propagate is set and there is no conflict; and valid, telling
+        # whether none of these was found and, if propagate is set, whether
+        # propagation went through. The grid is left as it was.
+        g = self.geometry
+        cells = self.cells
+        if len(cells) != g.cell_count:
+            raise SudokuError('Incorrect input')
+        seen = [0] * g.unit_count
+        first = {}
+        conflicts = set()
+        units = set()
+        for cell in range(g.cell_count):
+            digit = cells[cell]
+            if digit:
+                bit = g.digit_masks[digit]
+                for u in g.cell_units[cell]:
+                    if seen[u] & bit:
+                        conflicts.add(cell)
+                        conflicts.add(first[u, digit])
+                        units.add(u)
                     else:
-                        b = 3*(i//3) + j//3
-                        row_possibilities = self.possibilities[i].copy()
-                        row_possibilities.remove(possibilities)
-                        col_possibilities = self.possibilities_tran[j].copy()
-                        # print(elem, i, j)
-                        # print(self.possibilities)
-                        # print(possibilities, col_possibilities)
-                        # print(row_possibilities)
-                        col_possibilities.remove(possibilities)
-                        box_possibilities = self.possibilities_boxes[b].copy()
-                        box_possibilities.remove(possibilities)
-                        for poss in possibilities:
-                            row_poss = set()
-                            col_poss = set()
-                            box_poss = set()
-                            [row_poss.update(x) for x in row_possibilities]
-                            [col_poss.update(x) for x in col_possibilities]
-                            [box_poss.update(x) for x in box_possibilities]
-                            if poss not in box_poss: #or poss not in col_poss or poss not in row_poss:
-                                self.grid[i][j] = poss
-                                self.grid_tran = list(zip(*self.grid))
-                                self.boxes = self.split_to_boxes()
-                                grid_modified = True
-                                self.find_possibilities()
-                                # self.possibilities[i][j] = set()
-                                # [self.possibilities[i][r].discard(poss) for r in range(9)]
-                                # self.possibilities_tran = [list(x) for x in list(zip(*self.possibilities))]
-                                # self.possibilities_boxes = self.split_to_boxes(self.possibilities)
-                                # [self.possibilities_tran[j][r].discard(poss) for r in range(9)]
-                                # [self.possibilities_boxes[b][r].discard(poss) for r in range(9)]
-                                # self.forced_tex_output()
-
-        if grid_modified:
-            self.forced_tex_output()
-            # print(self.grid)
+                        seen[u] |= bit
+                        first[u, digit] = cell
+        consistent = True
+        if propagate and not conflicts:
+            mark = len(self.trail)
+            trace, self.trace = self.trace, None
+            try:
+                consistent = self.propagate()
+                empty = [cell for cell in range(g.cell_count) if not cells[cell] and not self.masks[cell]]
+            finally:
+                self.undo(mark)
+                self.trace = trace
         else:
-            with open(self.filename + '_forced.tex', 'w') as f:
-                vals = ['{}']*5
-                cons_vals = []
-                for i in range(9):
-                    for j in range(9):
-                        x = self.grid[i][j]
-                        if x > 0:
-                            vals[-1] = '{' + str(x) + '}'
-                        cons_vals.extend(vals)
-                        vals[-1] = '{}'
-                f.write(self.header)
-                f.write(self.template.format(*cons_vals))
-                f.write(self.footer)
-            self.forced = True
-            # print('\n\n\n')
-            # for line in self.possibilities:
-            #     print(line)
-            # for line in self.grid:
-            #     print(line)
-
-    def marked_tex_output(self):
+            empty = [cell for cell in range(g.cell_count) if not cells[cell] and not self.masks[cell]]
+        return {
+            'valid': consistent and not conflicts and not empty,
+            'conflicts': sorted(conflicts),
+            'units': [(g.unit_kinds[u], u % g.size) for u in sorted(units)],
+            'empty': empty,
+        }
+
+    def preassess(self):
+        # Prints whether some digit is given twice in a row, a column or a
+        # box, in which case there is clearly no solution.
+        if self.validate(propagate=False)['conflicts']:
+            print('There is clearly no solution.')
+        else:
+            print('There might be a solution.')
+
+    def force(self):
+        # Places the forced digits. The state of a stage is the one it was
+        # first reached in, whatever the calls made since.
+        start = time.perf_counter()
+        self.propagate()
+        self.stage_marks.setdefault(FORCED, len(self.trail))
+        self.forced = True
+        self.stats.add_time(FORCED, time.perf_counter() - start)
+
+    def mark(self):
+        # Places the forced digits if need be and records the state reached,
+        # whose candidates are those marked on the grid.
         if not self.forced:
-            self.forced_tex_output()
-        with open(self.filename + '_marked.tex', 'w') as f:
-            vals = ['{}'] * 5
-            cons_vals = []
-            for i in range(9):
-                for j in range(9):
-                    x = self.grid[i][j]
-                    if x > 0:
-                        vals[-1] = '{' + str(x) + '}'
-                    else:
-                        poss = self.possibilities[i][j]
-                        for k in range(1, 10):
-                            if k in poss:
-                                idx = 3 if k == 9 else (k-1) // 2
-                                # print(k, idx)
-                                vals[idx] = '{' + str(k) + '}' if vals[idx] == '{}' else vals[idx].split('}')[0] + ' ' + str(k) + '}'
-                    # print(vals)
-                    cons_vals.extend(vals)
-                    vals = ['{}']*5
-            f.write(self.header)
-            f.write(self.template.format(*cons_vals))
-            f.write(self.footer)
-        self.possibilities_after_marking = deepcopy(self.possibilities)
+            self.force()
+        start = time.perf_counter()
+        self.stage_marks.setdefault(MARKED, len(self.trail))
         self.marked = True
+        self.stats.add_time(MARKED, time.perf_counter() - start)
 
-
-    def is_preemptive(self, r, c):
-        poss = self.possibilities[r][c]
-        rcb = {ROW: False, COL: False, BOX: False}
-        poss_comb = self.poss_combos[r][c]
-        row_poss = self.possibilities[r]
-        col_poss = self.possibilities_tran[c]
-        b = 3 * (r // 3) + c // 3
-        box_poss = self.possibilities_boxes[b]
-        row_match = []
-        col_match = []
-        box_match = []
-
-        [box_match.append(i) for i, x in enumerate(box_poss) if x in poss_comb]
-        if len(box_match) == len(poss):
-            rcb[BOX] = True
-
-        [row_match.append(i) for i, x in enumerate(row_poss) if x in poss_comb]
-        if len(row_match) == len(poss):
-            rcb[ROW] = True
-
-        [col_match.append(i) for i, x in enumerate(col_poss) if x in poss_comb]
-        if len(col_match) == len(poss):
-            rcb[COL] = True
-
-        return rcb, {ROW: row_match, COL: col_match, BOX: box_match}
-
-    def handle_single_poss(self, r, c):
-        poss = self.possibilities[r][c].pop()
-        # print('pop', self.possibilities[i][j])
-        # print('poss', poss)
-        self.grid[r][c] = poss
-        self.grid_tran = list(zip(*self.grid))
-        self.boxes = self.split_to_boxes()
-        for i in range(9):
-            if poss in self.possibilities[r][i]:
-                self.possibilities[r][i].remove(poss)
-                if len(self.possibilities[r][i]) == 1:
-                    self.handle_single_poss(r, i)
-            if poss in self.possibilities[i][c]:
-                self.possibilities[i][c].remove(poss)
-                if len(self.possibilities[i][c]) == 1:
-                    self.handle_single_poss(i, c)
-        for b_i in range(r // 3 * 3, r // 3 * 3 + 3):
-            for b_j in range(c // 3 * 3, c // 3 * 3 + 3):
-                if poss in self.possibilities[b_i][b_j]:
-                    self.possibilities[b_i][b_j].remove(poss)
-                    if len(self.possibilities[b_i][b_j]) == 1:
-                        self.handle_single_poss(b_i, b_j)
-
-
-    def worked_tex_output(self):
+    def work(self):
+        # Marks the grid if need be and applies the preemptive sets.
         if not self.marked:
-            self.marked_tex_output()
-        self.find_poss_combos()
-
-        grid_changed = False
-        for i in range(9):
-            for j in range(9):
-                poss = self.possibilities[i][j]
-                b = 3 * (i // 3) + j // 3
-                if self.grid[i][j] == 0:
-                    res = self.is_preemptive(i, j)
-                    if res:
-
-                        rcb = res[0]
-                        if rcb[ROW]:
-                            matches = res[1][ROW]
-                            for col in range(9):
-                                if col not in matches and self.grid[i][col]==0:
-                                    if self.possibilities[i][col] != set(self.possibilities[i][col]).difference(poss):
-                                        grid_changed = True
-                                        self.possibilities[i][col] = set(self.possibilities[i][col]).difference(poss)
-                                        if len(self.possibilities[i][col]) == 1:
-                                            self.handle_single_poss(i, col)
-
-                        if rcb[COL]:
-                            matches = res[1][COL]
-                            for row in range(9):
-                                if row not in matches and self.grid[row][j]==0:
-                                    if self.possibilities[row][j] != set(self.possibilities[row][j]).difference(poss):
-                                        grid_changed = True
-                                        self.possibilities[row][j] = set(self.possibilities[row][j]).difference(poss)
-                                        if len(self.possibilities[row][j]) == 1:
-                                            self.handle_single_poss(row, j)
-
-                        if rcb[BOX]:
-                            matches = res[1][BOX]
-                            idx = 0
-                            for row in range(i//3 * 3, i//3 * 3 + 3):
-                                for col in range(j//3 * 3, j//3 * 3 + 3):
-                                    if idx not in matches and self.grid[row][col]==0:
-                                        if self.possibilities[row][col] != set(self.possibilities[row][col]).difference(poss):
-                                            grid_changed = True
-                                            self.possibilities[row][col] = set(
-                                                self.possibilities[row][col]).difference(poss)
-                                            if len(self.possibilities[row][col]) == 1:
-                                                self.handle_single_poss(row, col)
-                                    idx += 1
-
-                        self.possibilities_tran = [list(x) for x in list(zip(*self.possibilities))]
-                        self.possibilities_boxes = self.split_to_boxes(self.possibilities)
-                        self.find_poss_combos()
-
-        if grid_changed:
-            self.worked_tex_output()
+            self.mark()
+        start = time.perf_counter()
+        self.find_preemptive_sets()
+        self.stage_marks.setdefault(WORKED, len(self.trail))
+        self.worked = True
+        self.stats.add_time(WORKED, time.perf_counter() - start)
+
+    def tex_table(self, stage):
+        # Applies the techniques up to stage if they have not been yet and
+        # returns the TeX table of the grid at that stage.
+        tex = self.renderer
+        if stage == BARE:
+            return tex.table(self.stage_state(BARE)[0])
+        if stage == FORCED:
+            if not self.forced:
+                self.force()
+            return tex.table(self.cells_after_marking if self.marked else self.cells)
+        if stage == MARKED:
+            if not self.marked:
+                self.mark()
+            return tex.table(*self.stage_state(MARKED))
+        if stage == WORKED:
+            if not self.worked:
+                self.work()
+            cancelled = [0] * len(self.masks)
+            for cell, (digit, removed) in self.changes(self.stage_marks[MARKED]).items():
+                cancelled[cell] = removed
+            return tex.table(self.cells, self.masks, cancelled)
+        raise SudokuError('Unknown stage ' + str(stage))
+
+    def write_tex(self, out, stage):
+        # Writes the document of the grid at stage to out, or to the file
+        # filename_stage.tex if out is None.
+        if out is None:
+            with open(self.filename + '_' + stage + '.tex', 'w') as f:
+                self.renderer.write(f, [self.tex_table(stage)])
         else:
-            # TODO add writing to tex file
-            # for i in range(9):
-            #     for j in range(9):
-            #         if self.grid[i][j] == 0:
-            #             print(i, j, self.grid[i][j], self.possibilities[i][j])
-            # print()
-            # [print(x) for x in self.possibilities]
-            # [print(x) for x in self.grid]
-
-            cancelled_possibilities = deepcopy(self.possibilities)
-            for i in range(9):
-                for j in range(9):
-                    cancelled_possibilities[i][j] = self.possibilities_after_marking[i][j].difference(self.possibilities[i][j])
-            # print(cancelled_possibilities)
-            with open(self.filename + '_worked.tex', 'w') as f:
-                vals = ['{}'] * 5
-                cons_vals = []
-                for i in range(9):
-                    for j in range(9):
-                        x = self.grid[i][j]
-                        if x > 0:
-                            vals[-1] = '{' + str(x) + '}'
-                        poss = self.possibilities[i][j]
-                        cancelled_poss = cancelled_possibilities[i][j]
-                        CANCEL = '\cancel'
-                        for k in range(1, 10):
-                            idx = 3 if k == 9 else (k - 1) // 2
-                            if k in poss:
-                                # print(k, idx)
-                                vals[idx] = '{' + str(k) + '}' if vals[idx] == '{}' else vals[idx].split('}')[
-                                                                                             0] + ' ' + str(k) + '}'
-                            if k in cancelled_poss:
-                                # print(k, idx)
-                                tmp_cancel = CANCEL + '{' + str(k) + '}'
-                                vals[idx] = '{' + tmp_cancel + '}' if vals[idx] == '{}' else vals[idx][:-1] + ' ' + tmp_cancel + '}'
-                        # print(vals)
-                        cons_vals.extend(vals)
-                        vals = ['{}'] * 5
-                f.write(self.header)
-                f.write(self.template.format(*cons_vals))
-                f.write(self.footer)
-            
+            self.renderer.write(out, [self.tex_table(stage)])
+
+    def write_tex_steps(self, out, first=BARE, last=WORKED):
+        # Writes to out a document showing the grid and its candidates after
+        # each digit placed from stage first to stage last, replayed from
+        # the trail.
+        self.tex_table(last)
+        if first not in self.stage_marks or last not in self.stage_marks:
+            raise SudokuError('Stage not reached')
+        tables = (self.renderer.table(cells, masks)
+                  for cells, masks in self.states(self.stage_marks[first], self.stage_marks[last]))
+        self.renderer.write(out, tables)
 
+    def bare_tex_output(self, out=None):
+        self.write_tex(out, BARE)
+
+    def forced_tex_output(self, out=None):
+        self.force()
+        self.write_tex(out, FORCED)
+
+    def marked_tex_output(self, out=None):
+        if not self.forced and out is None:
+            self.forced_tex_output()
+        self.mark()
+        self.write_tex(out, MARKED)
+
+    def preemptive_set(self, u):
+        # Looks in unit u for a preemptive set, that is m empty cells whose
+        # candidates all lie among m digits, which still removes candidates
+        # from the unit. Only sets of at most half the empty cells are tried
+        # on both the cells (naked sets) and the digits (hidden sets) since
+        # the cells outside a preemptive set form one for the other digits,
+        # and none of more than SUBSET_LIMIT cells.
+        # Returns the list of (cell, digits to remove) pairs, or None.
+        g = self.geometry
+        masks = self.masks
+        free = [cell for cell in g.units[u] if masks[cell]]
+        cell_masks = [masks[cell] for cell in free]
+        limit = min(len(free) // 2, SUBSET_LIMIT)
+
+        for chosen, digits in subsets(cell_masks, limit):
+            found = [(cell, digits) for i, cell in enumerate(free)
+                     if not chosen >> i & 1 and cell_masks[i] & digits]
+            if found:
+                return found
+
+        places = [0] * g.size
+        for i, m in enumerate(cell_masks):
+            while m:
+                bit = m & -m
+                places[bit.bit_length() - 1] |= 1 << i
+                m ^= bit
+        for chosen, cells in subsets(places, limit):
+            found = [(cell, cell_masks[i] & ~chosen) for i, cell in enumerate(free)
+                     if cells >> i & 1 and cell_masks[i] & ~chosen]
+            if found:
+                return found
+        return None
+
+    def find_preemptive_sets(self, units=None):
+        # Applies preemptive sets, and the singles they leave, until none of
+        # them removes any more candidates. The given units (all units by
+        # default) are searched first, and a unit is searched again only once
+        # the candidates of one of its cells have changed. Returns False if
+        # the grid is found to have no solution.
+        g = self.geometry
+        masks = self.masks
+        stats = self.stats
+        trace = self.trace
+        dirty = deque(range(g.unit_count) if units is None else units)
+        queued = [False] * g.unit_count
+        for u in dirty:
+            queued[u] = True
+        while dirty:
+            u = dirty.popleft()
+            queued[u] = False
+            stats.unit_scans += 1
+            found = self.preemptive_set(u)
+            if found is None:
+                continue
+            stats.preemptive_sets[g.unit_kinds[u]] += 1
+            if trace is not None:
+                trace(PREEMPTIVE, u, found)
+            changed = []
+            for cell, digits in found:
+                stats.eliminations += (masks[cell] & digits).bit_count()
+                if trace is not None:
+                    trace(ELIMINATE, cell, masks[cell] & digits)
+                self.restrict(cell, masks[cell] & ~digits)
+                changed.append(cell)
+            if not self.propagate(changed, changed):
+                return False
+            for cell in changed:
+                for v in g.cell_units[cell]:
+                    if not queued[v]:
+                        dirty.append(v)
+                        queued[v] = True
+        return True
+
+    def most_constrained(self):
+        # Returns the empty cell with fewest candidates, or -1 if the grid is full.
+        masks = self.masks
+        best = -1
+        best_size = self.geometry.size + 1
+        for cell in range(len(masks)):
+            if self.cells[cell] == 0 and masks[cell].bit_count() < best_size:
+                best = cell
+                best_size = masks[cell].bit_count()
+                if best_size <= 2:
+                    break
+        return best
+
+    def search(self, stats, rng=None, deadline=None):
+        # Yields every completion of the grid, guessing in the most constrained
+        # cell and propagating singles after each guess, the candidates being
+        # tried in increasing order or shuffled by rng. A snapshot is taken
+        # before a guess and restored to try the next candidate, dropping the
+        # trail entries of the branch given up. Raises SudokuError('Timeout')
+        # once time.time() passes deadline, if one is given.
+        g = self.geometry
+        cells, masks = self.cells, self.masks
+        if not self.propagate():
+            return
+        stack = []
+        while True:
+            cell = self.most_constrained()
+            if cell < 0:
+                yield cells.copy()
+            else:
+                digits = g.mask_digits[masks[cell]]
+                if rng is not None:
+                    digits = rng.sample(digits, len(digits))
+                stack.append([self.snapshot(), cell, digits, 0])
+                stats['max_depth'] = max(stats['max_depth'], len(stack))
+
+            while stack:
+                frame = stack[-1]
+                saved, cell, digits, k = frame
+                if k == len(digits):
+                    stack.pop()
+                    stats['backtracks'] += 1
+                    continue
+                frame[3] = k + 1
+                self.restore(saved)
+                self.restrict(cell, g.digit_masks[digits[k]])
+                stats['nodes'] += 1
+                if deadline is not None and time.time() > deadline:
+                    raise SudokuError('Timeout')
+                if self.trace is not None:
+                    self.trace(GUESS, cell, digits[k])
+                if self.propagate([cell]):
+                    break
+            else:
+                return
+
+    def exact_cover(self, stats, deadline=None):
+        # Yields every completion of the grid found by Dancing Links on the
+        # constraints the current grid leaves open: each empty cell gets one
+        # digit and each unit gets each of its missing digits once.
+        g = self.geometry
+        columns = {}
+        rows = []
+        choices = []
+        for cell in range(g.cell_count):
+            for digit in g.mask_digits[self.masks[cell]]:
+                row = []
+                for key in [cell] + [(u, digit) for u in g.cell_units[cell]]:
+                    if key not in columns:
+                        columns[key] = len(columns)
+                    row.append(columns[key])
+                rows.append(row)
+                choices.append((cell, digit))
+        open_units = sum((g.all_digits & ~used).bit_count() for used in self.unit_used)
+        open_cells = self.cells.count(0)
+        if len(columns) != open_cells + open_units:
+            # Some empty cell or missing digit has no candidate left.
+            return
+        for solution in DancingLinks(len(columns), rows).search(stats, deadline):
+            cells = self.cells.copy()
+            for r in solution:
+                cell, digit = choices[r]
+                cells[cell] = digit
+            yield cells
+
+    def solutions(self, method=SEARCH, stats=None, rng=None, deadline=None):
+        # Yields the completions of the grid found by the given backend,
+        # leaving the state of the grid as it was. The search backend tries
+        # the candidates in random order if rng is given. Either backend
+        # raises SudokuError('Timeout') once time.time() passes deadline.
+        if stats is None:
+            stats = {'nodes': 0, 'backtracks': 0, 'max_depth': 0}
+        mark = len(self.trail)
+        try:
+            if method == SEARCH:
+                yield from self.search(stats, rng, deadline)
+            elif method == DLX:
+                yield from self.exact_cover(stats, deadline)
+            else:
+                raise SudokuError('Unknown method ' + str(method))
+        finally:
+            self.undo(mark)
+
+    def copy(self):
+        # Returns a grid in the same state, candidates included, with fresh
+        # stats and no trace.
+        sudoku = Sudoku.from_cells(self.cells.copy(), self.filename)
+        sudoku.masks = self.masks.copy()
+        return sudoku
+
+    def count_solutions(self, limit=2, processes=None):
+        # Counts the completions of the grid, stopping as soon as limit of
+        # them are found. The search starts from the forced digits and
+        # preemptive sets of a copy of the grid, which is left unchanged. With
+        # processes, the branches on the most constrained cell are searched
+        # in that many worker processes.
+        sudoku = self.copy()
+        if not (sudoku.is_consistent() and sudoku.propagate() and sudoku.find_preemptive_sets()):
+            return 0
+        cell = sudoku.most_constrained()
+        if cell < 0:
+            return 1
+        if not processes or processes < 2:
+            return sum(1 for _ in itertools.islice(sudoku.solutions(), limit))
+        branches = [(sudoku.cells, sudoku.masks, cell, digit, limit)
+                    for digit in sudoku.geometry.mask_digits[sudoku.masks[cell]]]
+        count = 0
+        with multiprocessing.Pool(min(processes, len(branches))) as pool:
+            for found in pool.imap_unordered(count_branch, branches):
+                count += found
+                if count >= limit:
+                    break
+        return min(count, limit)
+
+    def is_unique(self, processes=None):
+        return self.count_solutions(2, processes) == 1
+
+    def grade(self):
+        # Returns the deepest stage needed to solve a copy of the grid:
+        # GRADE_FORCED if forced digits are enough, GRADE_PREEMPTIVE if
+        # preemptive sets are needed and GRADE_SEARCH otherwise, or None if
+        # it has no solution.
+        sudoku = self.copy()
+        if not (sudoku.is_consistent() and sudoku.propagate()):
+            return None
+        if 0 not in sudoku.cells:
+            return GRADE_FORCED
+        if not sudoku.find_preemptive_sets():
+            return None
+        if 0 not in sudoku.cells:
+            return GRADE_PREEMPTIVE
+        return GRADE_SEARCH if sudoku.count_solutions(1) else None
+
+    def solve(self, method=SEARCH, deadline=None):
+        # Applies forced digits and preemptive sets, then completes the grid
+        # by search (SEARCH) or exact cover (DLX), giving up with
+        # SudokuError('Timeout') once time.time() passes deadline if one is
+        # given. Returns the completed grid and a dictionary of search
+        # statistics.
+        start = time.perf_counter()
+        stats = {'method': method, 'filled': 0, 'nodes': 0, 'backtracks': 0, 'max_depth': 0}
+        solution = None
+        if self.is_consistent() and self.propagate() and self.find_preemptive_sets():
+            stats['filled'] = len(self.cells) - self.cells.count(0)
+            solution = next(self.solutions(method, stats, deadline=deadline), None)
+        self.stats.add_search(stats)
+        self.stats.add_time('solve', time.perf_counter() - start)
+        if solution is None:
+            raise SudokuError('No solution')
+        for cell in range(len(solution)):
+            if self.cells[cell] == 0:
+                self.place(cell, solution[cell])
+        return self.grid, stats
+
+    def edit_cell(self, r, c):
+        # Returns the cell at row r and column c for set_cell() and
+        # clear_cell(), applying the techniques up to preemptive sets first
+        # if they have not been.
+        g = self.geometry
+        if not (isinstance(r, int) and isinstance(c, int) and 0 <= r < g.size and 0 <= c < g.size):
+            raise SudokuError('Incorrect input')
+        if not self.worked:
+            self.work()
+        if self.givens is None:
+            self.givens = frozenset(cell for cell, x in enumerate(self.stage_state(BARE)[0]) if x)
+        return g.size * r + c
+
+    def set_cell(self, r, c, d):
+        # Writes digit d in the cell at row r and column c, as a player
+        # would, and applies the forced digits and preemptive sets that
+        # follow. A digit the player wrote there before is cleared first,
+        # and written back if d turns out not to be allowed once it is.
+        # Returns the (row, column) pairs of the cells whose digit or
+        # candidates changed.
+        cell = self.edit_cell(r, c)
+        if not (isinstance(d, int) and 1 <= d <= self.geometry.size):
+            raise SudokuError('Incorrect input')
+        if cell in self.givens:
+            raise SudokuError('Cell is given')
+        changed = []
+        cleared = None
+        for other, digit, mark in self.edits:
+            if other == cell:
+                if digit == d:
+                    return []
+                cleared = mark, self.trail[mark:], self.edits.copy()
+                changed = self.clear_cell(r, c)
+                break
+        if self.cells[cell] != d and not self.masks[cell] & self.geometry.digit_masks[d]:
+            if cleared is not None:
+                mark, entries, self.edits = cleared
+                self.undo(mark)
+                self.redo(entries)
+            raise SudokuError('Digit not allowed')
+        return sorted(set(changed).union(self.replay(len(self.trail), [(cell, d)])))
+
+    def clear_cell(self, r, c):
+        # Erases the digit the player wrote in the cell at row r and column
+        # c. The grid is taken back to the state before that edit and the
+        # edits made since are placed again, so the candidates it removed
+        # come back. Returns the (row, column) pairs of the cells whose
+        # digit or candidates changed.
+        cell = self.edit_cell(r, c)
+        for other, digit, mark in self.edits:
+            if other == cell:
+                break
+        else:
+            raise SudokuError('Cell is not an edit')
+        later = [(other, digit) for other, digit, m in self.edits if m >= mark and other != cell]
+        return self.replay(mark, later)
+
+    def replay(self, mark, edits):
+        # Takes the grid back to the state named mark, forgetting the edits
+        # made since, then places the given (cell, digit) edits, dropping
+        # those whose digit is no longer a candidate, and applies singles and
+        # preemptive sets from the cells changed. Returns the (row, column)
+        # pairs of the cells whose digit or candidates differ from before.
+        g = self.geometry
+        cells, masks, trail = self.cells, self.masks, self.trail
+        before = {}
+        for i in range(mark, len(trail)):
+            cell = trail[i][0]
+            if cell not in before:
+                before[cell] = cells[cell], masks[cell]
+        self.undo(mark)
+        self.edits = [edit for edit in self.edits if edit[2] < mark]
+        placed = []
+        for cell, digit in edits:
+            bit = g.digit_masks[digit]
+            if cells[cell] == digit or (not cells[cell] and masks[cell] & bit):
+                self.edits.append((cell, digit, mark))
+                if not cells[cell]:
+                    self.restrict(cell, bit)
+                    placed.append(cell)
+        if placed:
+            changed = placed.copy()
+            if self.propagate(placed, changed):
+                self.find_preemptive_sets({u for cell in changed for u in g.cell_units[cell]})
+        # Only empty cells change, so a cell first changed now was empty
+        # with the mask before that change, as in the state named mark.
+        for i in range(mark, len(trail)):
+            cell, mask = trail[i][:2]
+            if cell not in before:
+                before[cell] = 0, mask
+        return sorted((g.row_of[cell], g.col_of[cell]) for cell, value in before.items()
+                      if (cells[cell], masks[cell]) != value)
+
+    @property
+    def cancelled_possibilities(self):
+        # Candidates shown after marking that the preemptive sets removed.
+        masks = self.masks
+        cancelled = [m & ~masks[cell] for cell, m in enumerate(self.masks_after_marking)]
+        return self.unit_possibilities(cancelled, self.geometry.row_units)
+
+    def worked_tex_output(self, out=None):
+        if not self.marked and out is None:
+            self.marked_tex_output()
+        self.work()
+        self.write_tex(out, WORKED)
 
 
 # s = Sudoku('sudoku_3.txt')
@@ -482,3 +1431,475 @@ class Sudoku(object):
 # s.bare_tex_output()
 # s.worked_tex_output()
 
+
+# Grids with more than this many orderings of their rows and columns to
+# compare in an orientation get no canonical form. Puzzles seldom have more
+# than a few; an empty grid has over a million.
+CANONICAL_LIMIT = 256
+
+
+def tied_orders(items, keys):
+    # Returns every ordering of items sorted by key, items of equal keys
+    # being taken in any order.
+    items = sorted(items, key=lambda i: keys[i])
+    groups = [list(itertools.permutations(group)) for _, group in itertools.groupby(items, key=lambda i: keys[i])]
+    return [sum(choice, ()) for choice in itertools.product(*groups)]
+
+
+def line_orders(keys, order=3):
+    # Yields the orderings of the rows (or columns) of a board of the given
+    # order that keep each band (or stack) together and sort both the bands
+    # and the lines within them by key, trying every order between equal
+    # keys.
+    band_keys = [tuple(sorted(keys[order*b : order*b + order])) for b in range(order)]
+    within = [tied_orders(range(order*b, order*b + order), keys) for b in range(order)]
+    for bands in tied_orders(range(order), band_keys):
+        for choice in itertools.product(*(within[b] for b in bands)):
+            yield sum(choice, ())
+
+
+def canonical_form(sudoku):
+    # Returns (key, order, digits) where key is a line of digits shared
+    # by the grids equal up to relabelling the digits, transposition, and
+    # permutations of the bands, the stacks and the rows and columns within
+    # them. Cell i of key is digits[grid[order[i]]]. The rows and columns are
+    # first sorted on invariants of their givens and only the orderings that
+    # tie are compared. Returns None if more than CANONICAL_LIMIT of them
+    # tie, as for grids with very few givens.
+    g = sudoku.geometry
+    size = g.size
+    grid = sudoku.cells
+    best = None
+    for source in (tuple(range(g.cell_count)), g.transposed):
+        cells = [grid[cell] for cell in source]
+        row_given = [sum(1 for cell in unit if cells[cell]) for unit in g.row_units]
+        col_given = [sum(1 for cell in unit if cells[cell]) for unit in g.col_units]
+        row_keys = [(row_given[r], tuple(sorted(col_given[g.col_of[cell]] for cell in g.row_units[r] if cells[cell])))
+                    for r in range(size)]
+        col_keys = [(col_given[c], tuple(sorted(row_given[g.row_of[cell]] for cell in g.col_units[c] if cells[cell])))
+                    for c in range(size)]
+        row_orders = list(itertools.islice(line_orders(row_keys, g.order), CANONICAL_LIMIT + 1))
+        col_orders = list(itertools.islice(line_orders(col_keys, g.order), CANONICAL_LIMIT + 1))
+        if len(row_orders) * len(col_orders) > CANONICAL_LIMIT:
+            return None
+        for rows, cols in itertools.product(row_orders, col_orders):
+            order = [source[size*r + c] for r in rows for c in cols]
+            digits = [0] * (size + 1)
+            label = 1
+            key = []
+            smaller = best is None
+            for i, cell in enumerate(order):
+                x = grid[cell]
+                if x and not digits[x]:
+                    digits[x] = label
+                    label += 1
+                y = digits[x]
+                if not smaller:
+                    if y > best[0][i]:
+                        break
+                    smaller = y < best[0][i]
+                key.append(y)
+            else:
+                if smaller:
+                    best = key, order, digits
+    key, order, digits = best
+    # Digits missing from the givens take the labels left after those of
+    # best, which need not be where the last ordering tried stopped.
+    label = max(digits) + 1
+    for x in range(1, size + 1):
+        if not digits[x]:
+            digits[x] = label
+            label += 1
+    return format_line(key), order, digits
+
+
+class SolutionCache(object):
+    # Keeps the results of run() for canonical forms of grids, the most
+    # recently used maxsize of them in memory and, if path is given, all of
+    # them in an SQLite file. A result holds the grid after forced digits
+    # (with the candidates marked) and after preemptive sets, and the
+    # solution, all in the frame of the canonical form.
+    def __init__(self, maxsize=1024, path=None, method=SEARCH):
+        self.maxsize = maxsize
+        self.method = method
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)')
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+                self.remember(key, result)
+                return result
+        return None
+
+    def put(self, key, result):
+        self.remember(key, result)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, json.dumps(result)))
+            self.db.commit()
+
+    def remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def compute(self, cells):
+        sudoku = Sudoku.from_cells(cells)
+        sudoku.mark()
+        forced, marked = sudoku.stage_state(MARKED)
+        result = {'forced': forced, 'marked': marked}
+        sudoku.work()
+        result['cells'] = sudoku.cells.copy()
+        result['masks'] = sudoku.masks.copy()
+        result['solution'] = None
+        if sudoku.is_consistent():
+            result['solution'] = next(sudoku.solutions(self.method), None)
+        return result
+
+    def run(self, sudoku):
+        # Brings sudoku to the state after preemptive sets, with its forced
+        # and marked states recorded for the TeX outputs, and returns its
+        # solution as rows of digits, or None if there is none. The grid is
+        # taken back to its givens first, keeping its stats and trace.
+        sudoku.undo(0)
+        sudoku.stage_marks = {BARE: 0}
+        sudoku.edits = []
+        sudoku.givens = None
+        g = sudoku.geometry
+        form = canonical_form(sudoku)
+        if form is None:
+            # Too few givens for a key worth keeping: solving is cheaper.
+            order, digits = range(g.cell_count), range(g.size + 1)
+            result = self.compute(sudoku.cells.copy())
+        else:
+            key, order, digits = form
+            result = self.get(key)
+            if result is None:
+                self.misses += 1
+                result = self.compute([digits[sudoku.cells[cell]] for cell in order])
+                self.put(key, result)
+            else:
+                self.hits += 1
+
+        inverse = [0] * (g.size + 1)
+        for x in range(g.size + 1):
+            inverse[digits[x]] = x
+        bits = [0] + [g.digit_masks[inverse[y]] for y in range(1, g.size + 1)]
+
+        def cells_back(values):
+            cells = [0] * g.cell_count
+            for i, y in enumerate(values):
+                cells[order[i]] = inverse[y]
+            return cells
+
+        def masks_back(values):
+            masks = [0] * g.cell_count
+            for i, m in enumerate(values):
+                for y in g.mask_digits[m]:
+                    masks[order[i]] |= bits[y]
+            return masks
+
+        sudoku.advance(cells_back(result['forced']), masks_back(result['marked']))
+        sudoku.stage_marks[FORCED] = sudoku.stage_marks[MARKED] = len(sudoku.trail)
+        sudoku.advance(cells_back(result['cells']), masks_back(result['masks']))
+        sudoku.stage_marks[WORKED] = len(sudoku.trail)
+        sudoku.forced = sudoku.marked = sudoku.worked = True
+        if result['solution'] is None:
+            return None
+        solution = cells_back(result['solution'])
+        return [solution[g.size*i : g.size*i + g.size] for i in range(g.size)]
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is needed for the batch functions')
+
+
+def batch_candidates(grids):
+    # Batched find_possibilities: takes an (N, 9, 9) array of grids, 0 for
+    # an empty cell, and returns the (N, 81, 9) boolean array telling for
+    # each cell whether each digit is a candidate.
+    require_numpy()
+    grids = np.asarray(grids).reshape(-1, 9, 9)
+    present = grids[..., None] == np.arange(1, 10)
+    row_used = present.any(axis=2)
+    col_used = present.any(axis=1)
+    box_used = present.reshape(-1, 3, 3, 3, 3, 9).any(axis=(2, 4))
+    box_used = box_used.repeat(3, axis=1).repeat(3, axis=2)
+    used = row_used[:, :, None, :] | col_used[:, None, :, :] | box_used
+    candidates = ~used & (grids == 0)[..., None]
+    return candidates.reshape(-1, 81, 9)
+
+
+def batch_validate(grids):
+    # Batched validate() without propagation: takes an (N, 9, 9) array of
+    # grids and returns the (N,) array telling which are valid, the (N, 81)
+    # array of the cells holding a digit repeated in one of their units and
+    # the (N, 81) array of the empty cells without candidates.
+    require_numpy()
+    grids = np.asarray(grids).reshape(-1, 9, 9)
+    present = grids[..., None] == np.arange(1, 10)
+    row_repeated = present.sum(axis=2, dtype=np.uint8) > 1
+    col_repeated = present.sum(axis=1, dtype=np.uint8) > 1
+    box_repeated = present.reshape(-1, 3, 3, 3, 3, 9).sum(axis=(2, 4), dtype=np.uint8) > 1
+    box_repeated = box_repeated.repeat(3, axis=1).repeat(3, axis=2)
+    repeated = row_repeated[:, :, None, :] | col_repeated[:, None, :, :] | box_repeated
+    conflicts = (repeated & present).any(axis=3).reshape(-1, 81)
+    empty = (grids == 0).reshape(-1, 81) & ~batch_candidates(grids).any(axis=2)
+    valid = ~(conflicts.any(axis=1) | empty.any(axis=1))
+    return valid, conflicts, empty
+
+
+def batch_propagate(grids, max_rounds=81):
+    # Places naked and hidden singles in all the (N, 9, 9) grids at once,
+    # round after round, until none of them changes any more. Returns the
+    # filled grids and, for each, SOLVED, STALLED (to be finished by Sudoku)
+    # or CONTRADICTION.
+    require_numpy()
+    cells = np.array(grids, dtype=np.int8).reshape(-1, 81)
+    units = np.array(UNITS)
+    digits = np.arange(1, 10, dtype=np.int8)
+    broken = np.zeros(len(cells), dtype=bool)
+    # Only the grids changed by the previous round are looked at again.
+    active = np.arange(len(cells))
+    for _ in range(max_rounds):
+        if not len(active):
+            break
+        current = cells[active]
+        candidates = batch_candidates(current)
+        in_units = candidates[:, units, :]
+        places = in_units.sum(axis=2)
+        present = (current[..., None] == digits)[:, units, :]
+        empty = current == 0
+        failed = (present.sum(axis=2) > 1).any(axis=(1, 2))
+        failed |= (empty & ~candidates.any(axis=2)).any(axis=1)
+        failed |= ((places == 0) & ~present.any(axis=2)).any(axis=(1, 2))
+        broken[active[failed]] = True
+
+        assign = np.zeros_like(current)
+        naked = empty & (candidates.sum(axis=2) == 1)
+        assign[naked] = candidates[naked].argmax(axis=1) + 1
+        n, u, i, d = np.nonzero(in_units & (places == 1)[:, :, None, :])
+        assign[n, units[u, i]] = d + 1
+        assign[failed] = 0
+        cells[active] = np.where(assign > 0, assign, current)
+        active = active[assign.any(axis=1)]
+
+    status = np.where(broken, CONTRADICTION, np.where((cells == 0).any(axis=1), STALLED, SOLVED))
+    return cells.reshape(-1, 9, 9), status
+
+
+def count_branch(branch):
+    # Counts, up to limit, the completions of the grid of the given cells
+    # and candidates once digit is placed in cell.
+    cells, masks, cell, digit, limit = branch
+    sudoku = Sudoku.from_cells(cells.copy())
+    sudoku.masks = masks.copy()
+    sudoku.restrict(cell, sudoku.geometry.digit_masks[digit])
+    if not sudoku.propagate([cell]):
+        return 0
+    return sum(1 for _ in itertools.islice(sudoku.solutions(), limit))
+
+
+# Grades of a puzzle, from the easiest: the deepest technique it needs.
+GRADE_FORCED = 'forced'
+GRADE_PREEMPTIVE = 'preemptive'
+GRADE_SEARCH = 'search'
+GRADES = (GRADE_FORCED, GRADE_PREEMPTIVE, GRADE_SEARCH)
+
+
+def random_grid(rng, order=3):
+    # Returns the cells of a random complete grid of the given order.
+    return next(Sudoku.from_cells([0] * order ** 4).solutions(rng=rng))
+
+
+def generate(rng, grade=GRADE_SEARCH, order=3):
+    # Removes clues from a random complete grid of the given order, in
+    # random order, as long as the puzzle keeps a unique solution and needs
+    # no deeper stage than grade. Returns the cells of the puzzle and its
+    # grade, which may be lower than asked for.
+    cells = random_grid(rng, order)
+    deepest = GRADES.index(grade)
+    for cell in rng.sample(range(len(cells)), len(cells)):
+        digit = cells[cell]
+        cells[cell] = 0
+        sudoku = Sudoku.from_cells(cells.copy())
+        found = sudoku.grade()
+        if found is None or GRADES.index(found) > deepest or (found == GRADE_SEARCH and not sudoku.is_unique()):
+            cells[cell] = digit
+    return cells, Sudoku.from_cells(cells.copy()).grade()
+
+
+def generate_puzzle(seed, grade=GRADE_SEARCH, tries=100):
+    # Returns the line of a puzzle of exactly the given grade, the same for
+    # the same seed, trying up to tries grids.
+    rng = random.Random(seed)
+    for _ in range(tries):
+        cells, found = generate(rng, grade)
+        if found == grade:
+            return format_line(cells)
+    raise SudokuError('No puzzle of grade ' + str(grade) + ' found')
+
+
+def generate_stream(count, grade=GRADE_SEARCH, seed=0, jobs=None):
+    # Yields count puzzle lines of the given grade, the i-th generated from
+    # the seed 'seed-i' so that the output only depends on seed, spread
+    # over jobs worker processes.
+    seeds = ('%s-%d' % (seed, i) for i in range(count))
+    worker = functools.partial(generate_puzzle, grade=grade)
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        yield from map(worker, seeds)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(worker, seeds)
+
+
+def solve_line(line, method=SEARCH):
+    # Solves the puzzle given as a line of characters. Returns the line of
+    # the solution, or the line as read if there is none, and a status.
+    line = line.strip()
+    try:
+        grid, stats = Sudoku.from_line(line).solve(method)
+    except SudokuError as e:
+        return line, INVALID if e.message == 'Incorrect input' else UNSOLVABLE
+    return format_line(x for row in grid for x in row), SOLVED
+
+
+def validate_lines(lines, propagate=True):
+    # Yields (line, result) for every non blank line of puzzles as in the
+    # batch mode, result being that of Sudoku.validate(), with error set to
+    # the message of the SudokuError raised by a line that cannot be read.
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            result = Sudoku.from_line(line).validate(propagate)
+            result['error'] = None
+        except SudokuError as e:
+            result = {'valid': False, 'conflicts': [], 'units': [], 'empty': [], 'error': e.message}
+        yield line, result
+
+
+def solve_lines(lines, method=SEARCH):
+    # Solves a chunk of lines in a worker process.
+    return [solve_line(line, method) for line in lines]
+
+
+def solve_stream(lines, jobs=None, chunksize=64, method=SEARCH):
+    # Yields (solution, status) for every non blank line, in input order,
+    # spreading the puzzles over a pool of jobs processes in chunks. At most
+    # 4 * jobs chunks are out at a time, read from lines by the caller's
+    # thread as results are consumed, so the input is never read whole and
+    # stopping early leaves no thread of the pool waiting on it.
+    lines = (line for line in lines if line.strip())
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        yield from map(functools.partial(solve_line, method=method), lines)
+        return
+    chunks = iter(lambda: list(itertools.islice(lines, chunksize)), [])
+    with multiprocessing.Pool(jobs) as pool:
+        pending = deque(pool.apply_async(solve_lines, (chunk, method)) for chunk in itertools.islice(chunks, 4 * jobs))
+        while pending:
+            results = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(solve_lines, (chunk, method)))
+            yield from results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m sudoku',
+        description='Solve puzzles given one per line as 81 characters (256 or 625 for 16x16 or 25x25 boards, '
+                    'with letters for the digits above 9), 0 or . for an empty cell.')
+    parser.add_argument('input', nargs='?', default='-', help='file of puzzles, - for standard input')
+    parser.add_argument('-o', '--output', default='-', help='file for the solutions, - for standard output')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-c', '--chunksize', type=int, default=64, help='puzzles sent to a worker at a time')
+    parser.add_argument('-m', '--method', choices=(SEARCH, DLX), default=SEARCH, help='search backend')
+    parser.add_argument('-g', '--generate', type=int, metavar='N', help='generate N puzzles instead of solving')
+    parser.add_argument('--grade', choices=GRADES, default=GRADE_SEARCH, help='grade of the generated puzzles')
+    parser.add_argument('--seed', default='0', help='seed of the generated puzzles')
+    parser.add_argument('--tex', help='file for a TeX document of the generated puzzles')
+    args = parser.parse_args(argv)
+
+    if args.generate is not None:
+        generate_main(args)
+        return
+
+    source = sys.stdin if args.input == '-' else open(args.input)
+    target = sys.stdout if args.output == '-' else open(args.output, 'w')
+    counts = {SOLVED: 0, UNSOLVABLE: 0, INVALID: 0}
+    start = time.perf_counter()
+    try:
+        for solution, status in solve_stream(source, args.jobs, args.chunksize, args.method):
+            counts[status] += 1
+            target.write(solution + ' ' + status + '\n')
+    except BrokenPipeError:
+        # The reader of the output went away, as with | head: stop quietly,
+        # without flushing to the closed pipe again at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), target.fileno())
+        return
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print('%d puzzles in %.2fs (%.0f/s): %d solved, %d unsolvable, %d invalid'
+          % (total, elapsed, total / elapsed if elapsed else 0, counts[SOLVED], counts[UNSOLVABLE], counts[INVALID]),
+          file=sys.stderr)
+
+
+def generate_main(args):
+    # Writes the generated puzzles to the output, one per line, and to the
+    # TeX document, as they come.
+    target = sys.stdout if args.output == '-' else open(args.output, 'w')
+    tex = open(args.tex, 'w') if args.tex else None
+    start = time.perf_counter()
+    count = 0
+
+    def tables():
+        nonlocal count
+        for line in generate_stream(args.generate, args.grade, args.seed, args.jobs):
+            count += 1
+            target.write(line + '\n')
+            if tex is not None:
+                yield Sudoku.from_line(line).tex_table(BARE)
+
+    try:
+        if tex is not None:
+            RENDERER.write(tex, tables())
+        else:
+            for _ in tables():
+                pass
+    finally:
+        if target is not sys.stdout:
+            target.close()
+        if tex is not None:
+            tex.close()
+    elapsed = time.perf_counter() - start
+    print('%d puzzles of grade %s in %.2fs (%.1f/s)' % (count, args.grade, elapsed, count / elapsed if elapsed else 0),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import os
+import random
+import unittest
+
+import sudoku
+
+PUZZLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sudoku_3.txt')
+
+
+def shuffle(cells, rng):
+    # Relabels the digits, permutes the bands, stacks, rows and columns of a
+    # 9x9 grid and transposes it half of the time.
+    digits = [0] + rng.sample(range(1, 10), 9)
+    rows = [3*b + r for b in rng.sample(range(3), 3) for r in rng.sample(range(3), 3)]
+    cols = [3*s + c for s in rng.sample(range(3), 3) for c in rng.sample(range(3), 3)]
+    transpose = rng.random() < 0.5
+    return [digits[cells[9*c + r] if transpose else cells[9*r + c]] for r in rows for c in cols]
+
+
+class SolutionCacheTest(unittest.TestCase):
+    def setUp(self):
+        # The givens of this puzzle have no 1, so canonical_form() has a
+        # digit to label after those it has seen.
+        self.missing, grade = sudoku.generate(random.Random(2))
+        self.assertNotIn(1, self.missing)
+        self.puzzles = [self.missing, sudoku.Sudoku(PUZZLE).cells.copy()]
+
+    def test_round_trip(self):
+        cache = sudoku.SolutionCache()
+        rng = random.Random(0)
+        for puzzle in self.puzzles:
+            for _ in range(6):
+                cells = shuffle(puzzle, rng)
+                cached = sudoku.Sudoku.from_cells(cells.copy())
+                solution = cache.run(cached)
+                direct = sudoku.Sudoku.from_cells(cells.copy())
+                direct.mark()
+                self.assertEqual(cached.stage_state(sudoku.MARKED), direct.stage_state(sudoku.MARKED))
+                direct.work()
+                self.assertEqual((cached.cells, cached.masks), (direct.cells, direct.masks))
+                self.assertEqual(solution, sudoku.Sudoku.from_cells(cells.copy()).solve()[0])
+        self.assertEqual(cache.misses, len(self.puzzles))
+
+    def test_missing_digit_labels(self):
+        key, order, digits = sudoku.canonical_form(sudoku.Sudoku.from_cells(self.missing.copy()))
+        self.assertEqual(sorted(digits), list(range(10)))
+
+    def test_keeps_trace(self):
+        s = sudoku.Sudoku.from_cells(self.missing.copy())
+        s.trace = print
+        stats = s.stats
+        sudoku.SolutionCache().run(s)
+        self.assertIs(s.trace, print)
+        self.assertIs(s.stats, stats)
+
+
+class EditTest(unittest.TestCase):
+    def setUp(self):
+        self.s = sudoku.Sudoku(PUZZLE)
+        self.solution = [x for row in sudoku.Sudoku(PUZZLE).solve()[0] for x in row]
+        self.s.work()
+        self.worked = self.s.cells.copy(), self.s.masks.copy()
+        self.empty = [cell for cell in range(81) if not self.s.cells[cell]]
+
+    def test_clear_restores(self):
+        cell = self.empty[0]
+        changed = self.s.set_cell(cell // 9, cell % 9, self.solution[cell])
+        self.assertIn((cell // 9, cell % 9), changed)
+        self.s.clear_cell(cell // 9, cell % 9)
+        self.assertEqual((self.s.cells, self.s.masks), self.worked)
+        self.assertEqual(self.s.edits, [])
+
+    def test_clear_replays_later_edits(self):
+        first, second = self.empty[0], self.empty[-1]
+        self.s.set_cell(first // 9, first % 9, self.solution[first])
+        if not self.s.cells[second]:
+            self.s.set_cell(second // 9, second % 9, self.solution[second])
+        self.s.clear_cell(first // 9, first % 9)
+        cells = sudoku.Sudoku(PUZZLE).cells
+        for cell, digit, mark in self.s.edits:
+            cells[cell] = digit
+        expected = sudoku.Sudoku.from_cells(cells)
+        expected.work()
+        self.assertEqual((self.s.cells, self.s.masks), (expected.cells, expected.masks))
+
+    def test_rejected_digit_keeps_edit(self):
+        cell = self.empty[0]
+        self.s.set_cell(cell // 9, cell % 9, self.solution[cell])
+        before = self.s.cells.copy(), self.s.masks.copy(), list(self.s.trail), list(self.s.edits)
+        bare = sudoku.Sudoku(PUZZLE).masks[cell]
+        wrong = next(d for d in range(1, 10) if not bare & sudoku.DIGIT_MASKS[d])
+        with self.assertRaises(sudoku.SudokuError):
+            self.s.set_cell(cell // 9, cell % 9, wrong)
+        self.assertEqual((self.s.cells, self.s.masks, self.s.trail, self.s.edits), before)
+
+    def test_given(self):
+        cell = next(cell for cell, x in enumerate(sudoku.Sudoku(PUZZLE).cells) if x)
+        with self.assertRaises(sudoku.SudokuError):
+            self.s.set_cell(cell // 9, cell % 9, 1)
+
+
+class ParseTest(unittest.TestCase):
+    def test_multi_digit_tokens(self):
+        with open(PUZZLE) as f:
+            rows = [line for line in f.read().splitlines() if line.strip()]
+        for token in ('08', '00', '01'):
+            tokens = rows[0].split()
+            tokens[-1] = token
+            with self.assertRaises(sudoku.SudokuError):
+                sudoku.parse_grid('\n'.join([' '.join(tokens)] + rows[1:]).encode())
+
+    def test_from_bytes_str(self):
+        with self.assertRaises(sudoku.SudokuError):
+            sudoku.Sudoku.from_bytes('0 0 1')
+
+
+if __name__ == '__main__':
+    unittest.main()